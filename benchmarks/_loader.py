@@ -0,0 +1,18 @@
+"""Helpers for loading the app module from the benchmark scripts"""
+import importlib.util
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_FILE = os.path.join(ROOT, "wifi-reconnector-code.py")
+
+
+def load_reconnector():
+    """Import wifi-reconnector-code.py (the dash in the name stops a normal import)"""
+    if "wifi_reconnector" in sys.modules:
+        return sys.modules["wifi_reconnector"]
+    spec = importlib.util.spec_from_file_location("wifi_reconnector", APP_FILE)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["wifi_reconnector"] = module
+    spec.loader.exec_module(module)
+    return module
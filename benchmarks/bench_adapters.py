@@ -0,0 +1,105 @@
+"""Vendor portal adapters against local stand-ins of each vendor's portal.
+
+For every portal in stub_vendors.py this checks the fingerprint picks the
+right adapter, then logs in twice over plain HTTP (auth_engine "http") -
+once with portal_adapters on and once with it off, which is the generic
+guess-the-form login. The generic StubPortal is fingerprinted too, to make
+sure a plain form isn't mistaken for a vendor, and the customised portals
+(which do get mistaken for one) have to log in through the generic login
+once the adapter fails. Prints JSON, and exits non-zero if any adapter
+picked the wrong vendor or any login with adapters on failed:
+
+    python benchmarks/bench_adapters.py
+    python benchmarks/bench_adapters.py --vendor fortinet --repeats 20
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from _loader import load_reconnector
+from stub_portal import StubPortal
+from stub_vendors import CUSTOMISED, VENDORS, VendorPortal
+
+
+def identify(app, login_url):
+    transport = app.HttpTransport(dns_ttl=0)
+    page = app.fetch_portal_page(transport, login_url)
+    adapter, score = app.identify_portal(page)
+    return {"vendor": adapter.name if adapter else None, "score": score}
+
+
+def log_in(app, portal, adapters, repeats):
+    reconnector = app.WifiReconnector()
+    reconnector.config.update({
+        "login_url": portal.login_url,
+        "username": portal.username,
+        "password": portal.password,
+        "auth_engine": "http",
+        "portal_adapters": adapters,
+        # Every run should do the whole login, not resend the last one
+        "login_replay": False,
+        "auth_verify_timeout": 2,
+    })
+    reconnector.backend = app.FakeBackend("LabWiFi")
+    reconnector.probe = app.ConnectivityProbe(reconnector.transport, [portal.probe_endpoint], timeout=2)
+
+    times, results = [], []
+    posts_before = portal.login_posts
+    for _ in range(repeats):
+        portal.logout()
+        start = time.perf_counter()
+        result = reconnector.log_in()
+        times.append(time.perf_counter() - start)
+        results.append(result)
+    return {
+        "succeeded": sum(1 for result in results if result.success),
+        "failures": sorted({result.reason for result in results if not result.success}),
+        "login_posts_per_login": (portal.login_posts - posts_before) / repeats,
+        "seconds_median": statistics.median(times),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--vendor", choices=VENDORS, action="append", help="just this vendor (can be repeated)")
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    # Keep the app's caches and logs out of the real home directory
+    os.environ["HOME"] = tempfile.mkdtemp(prefix="wifi-bench-")
+    os.makedirs(os.path.join(os.environ["HOME"], "Library", "Logs"), exist_ok=True)
+    app = load_reconnector()
+    app.logger.setLevel(logging.CRITICAL)
+
+    results, ok = [], True
+    for vendor in args.vendor or VENDORS:
+        with VendorPortal(vendor) as portal:
+            fingerprint = identify(app, portal.login_url)
+            adapter = log_in(app, portal, True, args.repeats)
+            generic = log_in(app, portal, False, args.repeats)
+        ok = ok and fingerprint["vendor"] == vendor and adapter["succeeded"] == args.repeats
+        results.append({"portal": vendor, "fingerprint": fingerprint, "adapter": adapter, "generic": generic})
+
+    for custom in CUSTOMISED:
+        with VendorPortal(custom) as portal:
+            fingerprint = identify(app, portal.login_url)
+            adapter = log_in(app, portal, True, args.repeats)
+        ok = ok and adapter["succeeded"] == args.repeats
+        results.append({"portal": custom, "fingerprint": fingerprint, "adapter": adapter})
+
+    with StubPortal() as portal:
+        fingerprint = identify(app, portal.login_url)
+    ok = ok and fingerprint["vendor"] is None
+    results.append({"portal": "generic form", "fingerprint": fingerprint})
+
+    print(json.dumps({"ok": ok, "results": results}, indent=2))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Compare time-to-authenticated for the HTTP and browser login engines.
+
+Runs both engines against the local stub portal and prints JSON results:
+
+    python benchmarks/bench_auth.py --rounds 20
+"""
+import argparse
+import json
+import statistics
+import time
+
+from _loader import load_reconnector
+from stub_portal import StubPortal
+
+
+def time_engine(reconnector, engine, rounds):
+    reconnector.config["auth_engine"] = engine
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        # force - we're timing the login itself, not the backoff and rate limits around it
+        ok = reconnector.authenticate(force=True)
+        elapsed = time.perf_counter() - start
+        if not ok:
+            return {"engine": engine, "error": "authentication failed"}
+        timings.append(elapsed)
+    return {
+        "engine": engine,
+        "rounds": rounds,
+        "mean_s": statistics.mean(timings),
+        "median_s": statistics.median(timings),
+        "max_s": max(timings),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--browser-rounds", type=int, default=3,
+                        help="Chrome is slow, so it gets fewer rounds by default")
+    args = parser.parse_args()
+
+    app = load_reconnector()
+    results = []
+    with StubPortal() as portal:
+        reconnector = app.WifiReconnector()
+        reconnector.config.update({
+            "login_url": portal.login_url,
+            "username": portal.username,
+            "password": portal.password,
+        })
+        # Logins are checked with a connectivity probe - make it ask the stub, not the internet
+        reconnector.probe = app.ConnectivityProbe(reconnector.transport, [portal.probe_endpoint], timeout=2)
+        results.append(time_engine(reconnector, "http", args.rounds))
+        if args.browser_rounds:
+            results.append(time_engine(reconnector, "browser", args.browser_rounds))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+"""End-to-end outage recovery benchmark.
+
+Runs the real monitor_connection loop against a FakeBackend (scriptable
+WiFi) and the stub captive portal, breaks the connection in different
+ways and measures how long it takes the monitor to notice and to get us
+back online. Each scenario runs in its own process so peak RSS is per
+scenario. Prints JSON (or writes it with --output):
+
+    python benchmarks/bench_recovery.py
+    python benchmarks/bench_recovery.py --scenario ssid_drop_events --repeats 10
+    python benchmarks/bench_recovery.py --engine asyncio
+
+CPU time covers the whole process, stub portal included - it's the same
+for every scenario, so it's fine for spotting regressions.
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+SCENARIOS = {
+    "ssid_drop": "WiFi drops, nothing tells the monitor - it finds out on its next check",
+    "ssid_drop_events": "WiFi drops and a network change event wakes the monitor",
+    "session_expiry": "portal session times out while still associated",
+    "slow_portal": "portal session ends and every portal response takes 300 ms",
+}
+
+SSID = "CampusWiFi"
+
+
+class Recorder:
+    """Wraps the app's hooks to timestamp what the monitor does"""
+
+    def __init__(self, reconnector):
+        self.events = []
+        self.cycles = 0
+        self.cond = threading.Condition()
+        metrics_state = reconnector.metrics.connection_state
+
+        def connection_state(online):
+            with self.cond:
+                self.events.append((time.monotonic(), online))
+                self.cond.notify_all()
+            metrics_state(online)
+
+        reconnector.metrics.connection_state = connection_state
+
+    def count_cycle(self, scheduler):
+        record = scheduler.record
+
+        def counted(healthy):
+            self.cycles += 1
+            record(healthy)
+
+        scheduler.record = counted
+
+    def wait_for(self, online, after, timeout):
+        """Time of the first state report matching `online` after `after`"""
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while True:
+                for stamp, state in self.events:
+                    if stamp >= after and state == online:
+                        return stamp
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+
+
+class SpawnCounter:
+    """Counts every process started through subprocess"""
+
+    def __init__(self):
+        self.count = 0
+        counter = self
+
+        class CountingPopen(subprocess.Popen):
+            def __init__(self, *args, **kwargs):
+                counter.count += 1
+                super().__init__(*args, **kwargs)
+
+        subprocess.Popen = CountingPopen
+
+
+def run_scenario(name, repeats, interval, engine="thread"):
+    # Keep the app's caches and logs out of the real home directory
+    home = tempfile.mkdtemp(prefix="wifi-bench-")
+    os.environ["HOME"] = home
+    os.makedirs(os.path.join(home, "Library", "Logs"), exist_ok=True)
+
+    from _loader import load_reconnector
+    from stub_portal import StubPortal
+
+    spawns = SpawnCounter()
+    app = load_reconnector()
+    app.logger.setLevel("WARNING")
+
+    portal = StubPortal(token_mode="static", session_ttl=None).start()
+    backend = app.FakeBackend(SSID, join_delay=0.2)
+    events = app.FakeEventSource()
+
+    reconnector = app.WifiReconnector()
+    reconnector.config.update({
+        "wifi_name": SSID,
+        "login_url": portal.login_url,
+        "username": portal.username,
+        "password": portal.password,
+        "check_interval": interval,
+        "min_check_interval": interval / 4,
+        "max_check_interval": interval,
+        "engine": engine,
+        # One instance, no herd to spread out - don't waste the run waiting for its first check
+        "start_jitter": 0,
+        # This measures recovering from a drop - logging in early would just dodge the session_expiry one
+        "session_refresh_lead": 0,
+        # Outages come every few seconds here - don't let the login rate limit get in the way
+        "auth_rate_per_minute": 600,
+    })
+    reconnector.reset_limits()
+    reconnector.backend = backend
+    reconnector.probe = app.ConnectivityProbe(reconnector.transport, [portal.probe_endpoint], timeout=2)
+    reconnector.event_sources = [events]
+    recorder = Recorder(reconnector)
+
+    reconnector.start_monitoring()
+    recorder.count_cycle(reconnector.scheduler)
+    if recorder.wait_for(True, 0, timeout=30) is None:
+        raise RuntimeError("monitor never got online to begin with")
+
+    detect, recover = [], []
+    cpu_start, cycles_start, spawns_start = time.process_time(), recorder.cycles, spawns.count
+    for _ in range(repeats):
+        # Let it settle, and break things at a random point in the check cycle
+        time.sleep(random.uniform(interval / 2, interval * 1.5))
+        if name == "session_expiry":
+            portal.session_ttl = interval / 4
+            portal.authenticated_at = time.monotonic()
+            dropped = portal.session_expires_at
+            time.sleep(max(0, dropped - time.monotonic()))
+            portal.session_ttl = None
+            portal.logout()
+        else:
+            dropped = time.monotonic()
+            if name == "slow_portal":
+                portal.delay = 0.3
+                portal.logout()
+            else:
+                backend.set_link(None)
+                portal.logout()
+                if name == "ssid_drop_events":
+                    events.trigger("link down")
+
+        noticed = recorder.wait_for(False, dropped, timeout=interval * 4)
+        restored = recorder.wait_for(True, noticed or dropped, timeout=60)
+        portal.delay = 0
+        if noticed is None or restored is None:
+            raise RuntimeError(f"{name}: monitor didn't recover")
+        detect.append(noticed - dropped)
+        recover.append(restored - dropped)
+
+    cpu = time.process_time() - cpu_start
+    cycles = max(1, recorder.cycles - cycles_start)
+    process_spawns = spawns.count - spawns_start
+    reconnector.stop_monitoring()
+    portal.stop()
+
+    return {
+        "scenario": name,
+        "description": SCENARIOS[name],
+        "engine": engine,
+        "repeats": repeats,
+        "check_interval_s": interval,
+        "time_to_detect_s": {"mean": sum(detect) / len(detect), "max": max(detect)},
+        "time_to_recover_s": {"mean": sum(recover) / len(recover), "max": max(recover)},
+        "cycles": cycles,
+        "cpu_ms_per_cycle": cpu / cycles * 1000,
+        "process_spawns_per_cycle": process_spawns / cycles,
+        # ru_maxrss is in kilobytes on Linux but bytes on macOS
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), action="append",
+                        help="run just this scenario (can be repeated)")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--interval", type=float, default=2.0, help="check_interval for the monitor")
+    parser.add_argument("--engine", choices=["thread", "asyncio"], default="thread", help="monitor engine to run")
+    parser.add_argument("--output", help="write the JSON results here as well")
+    parser.add_argument("--in-process", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.in_process:
+        print(json.dumps(run_scenario(args.scenario[0], args.repeats, args.interval, args.engine)))
+        return
+
+    results = []
+    for name in args.scenario or sorted(SCENARIOS):
+        output = subprocess.check_output([
+            sys.executable, os.path.abspath(__file__), "--in-process", "--scenario", name,
+            "--repeats", str(args.repeats), "--interval", str(args.interval), "--engine", args.engine,
+        ], cwd=os.path.dirname(os.path.abspath(__file__)))
+        results.append(json.loads(output.decode("utf-8").strip().splitlines()[-1]))
+
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""Portal session expiry - how much downtime with and without early re-login.
+
+Runs the monitor against the stub portal with a fixed session_ttl and
+watches the portal's own view of the session (every 10 ms) for gaps where
+the machine wasn't logged in. With session_refresh_lead at 0 every expiry
+is an outage until the next check notices. With it on, the app learns the
+lifetime from the first couple of expiries and then logs in again just
+before each one. Prints JSON:
+
+    python benchmarks/bench_session.py --ttl 6 --sessions 8
+"""
+import argparse
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from _loader import load_reconnector
+from stub_portal import StubPortal
+
+SSID = "CampusWiFi"
+
+
+def watch(portal, stop, gaps):
+    """Record (start, end) of every stretch the portal had us logged out"""
+    logged_out_since = None
+    seen_login = False
+    while not stop.is_set():
+        now = time.monotonic()
+        if portal.authenticated:
+            seen_login = True
+            if logged_out_since is not None:
+                gaps.append((logged_out_since, now))
+                logged_out_since = None
+        elif seen_login and logged_out_since is None:
+            logged_out_since = now
+        time.sleep(0.01)
+
+
+def run(app, ttl, sessions, interval, lead):
+    portal = StubPortal(token_mode="static", session_ttl=ttl).start()
+    reconnector = app.WifiReconnector()
+    reconnector.config.update({
+        "wifi_name": SSID,
+        "login_url": portal.login_url,
+        "username": portal.username,
+        "password": portal.password,
+        "check_interval": interval,
+        "min_check_interval": interval / 4,
+        "max_check_interval": interval,
+        "start_jitter": 0,
+        "session_refresh_lead": lead,
+        # Sessions here last seconds, not hours - don't let the login rate limit get in the way
+        "auth_rate_per_minute": 600,
+    })
+    # Apply the rate limit and lead to the objects built from the config
+    reconnector.reset_limits()
+    reconnector.backend = app.FakeBackend(SSID)
+    reconnector.probe = app.ConnectivityProbe(reconnector.transport, [portal.probe_endpoint], timeout=2)
+    reconnector.event_sources = []
+
+    stop, gaps = threading.Event(), []
+    watcher = threading.Thread(target=watch, args=(portal, stop, gaps), daemon=True)
+    watcher.start()
+    reconnector.start_monitoring()
+    time.sleep(ttl * sessions)
+    reconnector.stop_monitoring()
+    stop.set()
+    watcher.join()
+    portal.stop()
+
+    return {
+        "session_refresh_lead": lead,
+        "duration_s": ttl * sessions,
+        "outages": len(gaps),
+        "downtime_s": round(sum(end - start for start, end in gaps), 3),
+        "outage_s": [round(end - start, 3) for start, end in gaps],
+        "logins": portal.logins,
+        "session": reconnector.session.status(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--ttl", type=float, default=6.0, help="portal session lifetime in seconds")
+    parser.add_argument("--sessions", type=int, default=8, help="how many lifetimes to run each mode for")
+    parser.add_argument("--interval", type=float, default=4.0, help="check_interval for the monitor")
+    parser.add_argument("--lead", type=float, default=60, help="session_refresh_lead for the early re-login run")
+    args = parser.parse_args()
+
+    # Keep the app's caches and logs out of the real home directory
+    os.environ["HOME"] = tempfile.mkdtemp(prefix="wifi-bench-")
+    os.makedirs(os.path.join(os.environ["HOME"], "Library", "Logs"), exist_ok=True)
+    app = load_reconnector()
+    app.logger.setLevel(logging.WARNING)
+
+    results = [run(app, args.ttl, args.sessions, args.interval, lead) for lead in (0, args.lead)]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Regression check: a learned session mustn't make the monitor spin while offline.
+
+Once the app knows how long portal sessions last, the monitor wakes up in
+time to log in again before one runs out. If the network goes away with
+that refresh time already behind us, the wait until it is zero and the
+loop used to go round as fast as it could, probing and logging in without
+a break. This gives each engine a session whose refresh is overdue, points
+the probe and the login page at a closed port, and counts monitor cycles.
+Prints JSON, and exits non-zero if either engine went round much more often
+than min_check_interval allows:
+
+    python benchmarks/bench_session_offline.py --seconds 5
+"""
+import argparse
+import json
+import logging
+import os
+import socket
+import sys
+import tempfile
+import time
+
+from _loader import load_reconnector
+
+SSID = "CampusWiFi"
+
+
+def closed_port():
+    """A localhost port nothing is listening on"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def run(app, engine, seconds, min_interval):
+    url = f"http://127.0.0.1:{closed_port()}"
+    reconnector = app.WifiReconnector()
+    reconnector.config.update({
+        "wifi_name": SSID,
+        "login_url": url + "/login",
+        "username": "student",
+        "password": "hunter2",
+        "auth_engine": "http",
+        "engine": engine,
+        "check_interval": min_interval,
+        "min_check_interval": min_interval,
+        "max_check_interval": min_interval,
+        "start_jitter": 0,
+        "schedule_jitter": 0,
+        "quality_sample_interval": 0,
+        "auth_rate_per_minute": 6000,
+    })
+    reconnector.reset_limits()
+    reconnector.backend = app.FakeBackend(SSID)
+    reconnector.probe = app.ConnectivityProbe(reconnector.transport, [{"url": url + "/generate_204", "status": 204}],
+                                              timeout=1)
+    reconnector.event_sources = []
+
+    # A couple of 20 s sessions already seen, and the current one 30 s old - the refresh is overdue
+    session = reconnector.session
+    session.lifetimes.extend([20, 20])
+    session.started()
+    session.started_at -= 30
+
+    # Both engines finish every cycle with scheduler.record()
+    cycles = []
+    record = app.MonitorScheduler.record
+
+    def counting(scheduler, healthy):
+        cycles.append(healthy)
+        record(scheduler, healthy)
+
+    app.MonitorScheduler.record = counting
+    try:
+        reconnector.start_monitoring()
+        time.sleep(seconds)
+        reconnector.stop_monitoring()
+    finally:
+        app.MonitorScheduler.record = record
+
+    allowed = seconds / min_interval + 2
+    return {
+        "engine": engine,
+        "seconds": seconds,
+        "cycles": len(cycles),
+        "cycles_allowed": int(allowed),
+        "healthy_cycles": sum(cycles),
+        "ok": len(cycles) <= allowed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--min-interval", type=float, default=1.0, help="min_check_interval for the monitor")
+    args = parser.parse_args()
+
+    # Keep the app's caches and logs out of the real home directory
+    os.environ["HOME"] = tempfile.mkdtemp(prefix="wifi-bench-")
+    os.makedirs(os.path.join(os.environ["HOME"], "Library", "Logs"), exist_ok=True)
+    app = load_reconnector()
+    app.logger.setLevel(logging.CRITICAL)
+
+    results = [run(app, engine, args.seconds, args.min_interval) for engine in ("thread", "asyncio")]
+    ok = all(result["ok"] for result in results)
+    print(json.dumps({"ok": ok, "results": results}, indent=2))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Cold-start cost of the app module, with and without the heavy imports.
+
+"lazy" is importing wifi-reconnector-code.py as it is now - what --daemon
+and --check-once pay. "eager" also imports selenium, webdriver_manager,
+tkinter and rumps up front, like the module used to. Each run is a fresh
+interpreter; import times come from `python -X importtime`. Modules that
+aren't installed (rumps on Linux) are skipped and listed.
+
+    python benchmarks/bench_startup.py --runs 10
+"""
+import argparse
+import importlib.util
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from _loader import APP_FILE
+
+HEAVY_MODULES = [
+    "selenium.webdriver",
+    "selenium.webdriver.support.ui",
+    "webdriver_manager.chrome",
+    "tkinter",
+    "rumps",
+]
+
+LOAD_APP = (
+    "import importlib.util\n"
+    f"spec = importlib.util.spec_from_file_location('wifi_reconnector', {APP_FILE!r})\n"
+    "spec.loader.exec_module(importlib.util.module_from_spec(spec))\n"
+)
+
+
+def import_time_us(stderr):
+    """Add up the cumulative time of the top-level imports in -X importtime output"""
+    total = 0
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split(":", 1)[1].split("|")
+        # Nested imports are indented under their parent
+        if not name[1:].startswith(" "):
+            total += int(cumulative)
+    return total
+
+
+def measure(code, runs, env):
+    walls, imports = [], []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                                capture_output=True, text=True, env=env)
+        walls.append(time.perf_counter() - start)
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.strip().splitlines()[-1])
+        imports.append(import_time_us(result.stderr))
+    return {
+        "runs": runs,
+        "wall_ms_median": statistics.median(walls) * 1000,
+        "wall_ms_min": min(walls) * 1000,
+        "import_ms_median": statistics.median(imports) / 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    # The module shouldn't write anything on import, but don't take chances with the real home
+    env = dict(os.environ, HOME=tempfile.mkdtemp(prefix="wifi-bench-"))
+    available = [name for name in HEAVY_MODULES if importlib.util.find_spec(name.split(".")[0])]
+    eager = "".join(f"import {name}\n" for name in available) + LOAD_APP
+
+    lazy_result = measure(LOAD_APP, args.runs, env)
+    eager_result = measure(eager, args.runs, env)
+    print(json.dumps({
+        "lazy": lazy_result,
+        "eager": dict(eager_result, modules=available,
+                      skipped=[name for name in HEAVY_MODULES if name not in available]),
+        "saved_ms_median": eager_result["wall_ms_median"] - lazy_result["wall_ms_median"],
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
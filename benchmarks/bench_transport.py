@@ -0,0 +1,61 @@
+"""Per-check latency and CPU cost: fresh connections vs. the shared transport.
+
+"before" is what is_connected() used to do - a brand new requests.get each
+time, with its own DNS lookup and TCP handshake. "after" goes through
+HttpTransport with keep-alive and the DNS cache. The stand-in server is the
+stub portal's /generate_204 with interception switched off.
+
+    python benchmarks/bench_transport.py --checks 200
+"""
+import argparse
+import json
+import statistics
+import time
+
+import requests
+
+from _loader import load_reconnector
+from stub_portal import StubPortal
+
+
+def measure(check, checks):
+    latencies = []
+    cpu_start = time.process_time()
+    for _ in range(checks):
+        start = time.perf_counter()
+        response = check()
+        latencies.append(time.perf_counter() - start)
+        assert response.status_code == 204
+    cpu = time.process_time() - cpu_start
+    latencies.sort()
+    return {
+        "checks": checks,
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        "cpu_ms_per_check": cpu / checks * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--checks", type=int, default=200)
+    parser.add_argument("--host", default="localhost",
+                        help="hostname to use, so the DNS lookup is part of the cost")
+    args = parser.parse_args()
+
+    app = load_reconnector()
+    with StubPortal(intercept=False) as portal:
+        url = f"http://{args.host}:{portal.server.server_address[1]}/generate_204"
+        before = measure(lambda: requests.get(url, timeout=5, allow_redirects=False), args.checks)
+        transport = app.HttpTransport()
+        try:
+            after = measure(lambda: transport.get(url, allow_redirects=False), args.checks)
+            after["dns_cache_hits"] = transport.dns.hits
+        finally:
+            transport.close()
+    print(json.dumps({"before": before, "after": after}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""Herd simulation - a lab full of machines recovering from the same blip.
+
+Starts a rate-limited stub portal and hundreds of app instances (FakeBackend
+WiFi, each with its own portal session), spread over a few worker processes
+with a monitor thread per instance. Once everyone is online it knocks them
+all off at once - every portal session ends, WiFi drops and every instance
+gets a network change event - and measures how long each one takes to get
+back online. Each profile gets a fresh portal and fresh instances, and the
+results come out as JSON:
+
+    python benchmarks/sim_herd.py --instances 300 --rate-limit 50
+    python benchmarks/sim_herd.py --profile herd-safe --processes 8
+
+"lockstep" is how the app used to behave: everyone checks, rejoins and logs
+in the moment they notice, and retries straight away. "herd-safe" uses the
+shipped scheduling defaults plus a herd_jitter_window sized to what the
+portal can take. Both run with the shipped auth breaker settings, so an
+instance whose breaker opens stays locked out for the rest of the run -
+auth_breakers_after_blip counts those.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import statistics
+import tempfile
+import time
+
+SSID = "LabWiFi"
+
+
+def profiles(instances, rate_limit):
+    # Each login is two portal requests (the form and the post) - leave the portal some headroom
+    window = 2 * 2 * instances / rate_limit
+    return {
+        "lockstep": dict(start_jitter=0, schedule_jitter=0, herd_jitter_window=0,
+                         auth_burst=1000, auth_rate_per_minute=60000, retry_base_delay=0),
+        "herd-safe": dict(start_jitter=window, herd_jitter_window=window),
+    }
+
+
+def summary(values):
+    done = sorted(value for value in values if value is not None)
+    if not done:
+        return {"recovered": 0, "not_recovered": len(values)}
+    return {
+        "recovered": len(done),
+        "not_recovered": len(values) - len(done),
+        "p50": statistics.median(done),
+        "p95": done[min(len(done) - 1, int(len(done) * 0.95))],
+        "max": done[-1],
+    }
+
+
+def run_worker(conn, clients, base_url, settings, interval, timeout):
+    """One worker process - a thread per simulated machine"""
+    # Keep the app's caches and logs out of the real home directory
+    home = tempfile.mkdtemp(prefix="wifi-sim-")
+    os.environ["HOME"] = home
+    os.makedirs(os.path.join(home, "Library", "Logs"), exist_ok=True)
+
+    from _loader import load_reconnector
+    app = load_reconnector()
+    # Hundreds of instances hitting an overloaded portal log a lot
+    app.logger.setLevel(logging.CRITICAL)
+
+    machines = []
+    for client in clients:
+        reconnector = app.WifiReconnector()
+        reconnector.config.update(settings)
+        reconnector.config.update({
+            "wifi_name": SSID,
+            "login_url": f"{base_url}/c/{client}/login",
+            "username": "student",
+            "password": "hunter2",
+            "login_replay": False,
+            "host_id": f"sim-{client}",
+            "check_interval": interval,
+            "min_check_interval": interval / 4,
+            "max_check_interval": interval,
+        })
+        reconnector.backend = app.FakeBackend(SSID, join_delay=0.2)
+        reconnector.probe = app.ConnectivityProbe(
+            reconnector.transport, [{"url": f"{base_url}/c/{client}/generate_204", "status": 204}], timeout=5)
+        events = app.FakeEventSource()
+        reconnector.event_sources = [events]
+        # (time.monotonic(), online) for every state the monitor reports
+        reports = []
+        state = reconnector.metrics.connection_state
+
+        def connection_state(online, reports=reports, state=state):
+            reports.append((time.monotonic(), online))
+            state(online)
+
+        reconnector.metrics.connection_state = connection_state
+        # time.monotonic() of every time this instance's auth breaker opened
+        breaker = reconnector.auth_breaker
+        opened = []
+
+        def set_state(state, opened=opened, set_state=breaker.set_state):
+            if state == app.OPEN:
+                opened.append(time.monotonic())
+            set_state(state)
+
+        breaker.set_state = set_state
+        reconnector.breaker_opened = opened
+        machines.append((reconnector, events, reports))
+
+    def online_since(reports, since):
+        return next((stamp - since for stamp, online in reports if stamp >= since and online), None)
+
+    def wait_all(since):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if all(online_since(reports, since) is not None for _, _, reports in machines):
+                break
+            time.sleep(0.1)
+        return [online_since(reports, since) for _, _, reports in machines]
+
+    started = time.monotonic()
+    for reconnector, _, _ in machines:
+        reconnector.start_monitoring()
+    startup = wait_all(started)
+    conn.send(startup)
+
+    conn.recv()
+    blip = time.monotonic()
+    for reconnector, events, _ in machines:
+        reconnector.backend.set_link(None)
+        events.trigger("link down")
+    recovery = wait_all(blip)
+
+    attempts = sum(reconnector.metrics.counters["auth_attempts_total"] for reconnector, _, _ in machines)
+    breakers = {
+        # Instances whose breaker opened after the blip, and ones still locked out at the end
+        "opened": sum(1 for reconnector, _, _ in machines if any(t >= blip for t in reconnector.breaker_opened)),
+        "open_at_end": sum(1 for reconnector, _, _ in machines if reconnector.auth_breaker.state == app.OPEN),
+    }
+    for reconnector, _, _ in machines:
+        reconnector.running = False
+        reconnector.scheduler.stop()
+    conn.send((recovery, attempts, breakers))
+
+
+def simulate(name, settings, args):
+    from stub_portal import StubPortal
+
+    portal = StubPortal(token_mode="static", login_rate_limit=args.rate_limit).start()
+    context = multiprocessing.get_context("spawn")
+    workers = []
+    for index in range(args.processes):
+        clients = list(range(index, args.instances, args.processes))
+        parent, child = context.Pipe()
+        process = context.Process(target=run_worker, daemon=True, args=(
+            child, clients, portal.base_url, settings, args.interval, args.timeout))
+        process.start()
+        workers.append((process, parent))
+
+    startup = [value for _, conn in workers for value in conn.recv()]
+    # Everyone's online - now the network blips for the whole lab at once
+    requests_before, limited_before = portal.login_requests, portal.rate_limited
+    portal.logout_all()
+    for _, conn in workers:
+        conn.send("blip")
+    recovery, attempts, breakers = [], 0, {"opened": 0, "open_at_end": 0}
+    for process, conn in workers:
+        times, worker_attempts, worker_breakers = conn.recv()
+        recovery.extend(times)
+        attempts += worker_attempts
+        for key, count in worker_breakers.items():
+            breakers[key] += count
+        process.join(timeout=5)
+    portal.stop()
+
+    return {
+        "profile": name,
+        "settings": settings,
+        "instances": args.instances,
+        "processes": args.processes,
+        "portal_rate_limit": args.rate_limit,
+        "startup_s": summary(startup),
+        "recovery_s": summary(recovery),
+        "auth_attempts": attempts,
+        "auth_breakers_after_blip": breakers,
+        "portal_login_requests_after_blip": portal.login_requests - requests_before,
+        "portal_rejected_after_blip": portal.rate_limited - limited_before,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--instances", type=int, default=200)
+    parser.add_argument("--processes", type=int, default=4, help="worker processes to spread the instances over")
+    parser.add_argument("--rate-limit", type=int, default=40, help="portal login requests per second")
+    parser.add_argument("--interval", type=float, default=4.0, help="check_interval for every instance")
+    parser.add_argument("--timeout", type=float, default=60, help="give up on stragglers after this long")
+    parser.add_argument("--profile", choices=["lockstep", "herd-safe"], action="append",
+                        help="run just this profile (can be repeated)")
+    args = parser.parse_args()
+
+    available = profiles(args.instances, args.rate_limit)
+    results = [simulate(name, available[name], args) for name in args.profile or available]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+"""A tiny local captive portal for benchmarking the login engines.
+
+Serves a login form with a hidden token at /login and checks the posted
+credentials. /generate_204 behaves like the real connectivity check: it
+answers 204 once you're logged in (or interception is off), and redirects
+to the login page otherwise.
+
+Tokens are one-time by default. With token_mode="static" the same token
+is handed out until rotate_token() is called, like a CSRF token tied to
+a portal session - that's what makes a recorded login replayable.
+
+session_ttl makes logins expire like a real portal session does, and
+delay slows every response down.
+
+Lots of simulated machines can share one portal: everything under
+/c/<client>/ (see login_url_for and probe_endpoint_for) has its own session.
+login_rate_limit caps login page loads and posts per second across all
+clients - anything over gets a 503, like an overloaded portal.
+
+Run it directly to poke at it by hand:
+
+    python benchmarks/stub_portal.py --port 8080
+"""
+import argparse
+import secrets
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+LOGIN_PAGE = """<html><body>
+<form method="post" action="login">
+  <input type="hidden" name="token" value="{token}">
+  <input type="text" id="username" name="username">
+  <input type="password" id="password" name="password">
+  <button type="submit" name="login" value="1">Log in</button>
+</form>
+</body></html>"""
+
+# Same form, but only created once the script runs - the HTTP engine can't see it
+JS_LOGIN_PAGE = """<html><body><div id="app"></div>
+<script>
+document.getElementById("app").innerHTML = {form!r};
+</script>
+</body></html>"""
+
+SUCCESS_PAGE = "<html><body><h1>You are now connected</h1></body></html>"
+
+
+class PortalServer(ThreadingHTTPServer):
+    # The default backlog of 5 drops connections when a few hundred simulated clients show up at once
+    request_queue_size = 256
+    daemon_threads = True
+
+
+class StubPortal:
+    """Captive portal stand-in running on a background thread"""
+
+    def __init__(self, username="student", password="hunter2", js_only=False, intercept=True,
+                 token_mode="one-time", session_ttl=None, delay=0, login_rate_limit=None, port=0):
+        self.username = username
+        self.password = password
+        self.token_mode = token_mode
+        self.static_token = secrets.token_hex(8)
+        self.js_only = js_only
+        self.intercept = intercept
+        self.session_ttl = session_ttl
+        self.delay = delay
+        self.login_rate_limit = login_rate_limit
+        # client -> time.monotonic() of its login; "" is the client without a /c/ prefix
+        self.sessions = {}
+        self.recent_logins = deque()
+        self.tokens = set()
+        self.logins = 0
+        self.login_requests = 0
+        self.rate_limited = 0
+        self.lock = threading.Lock()
+        self.server = PortalServer(("127.0.0.1", port), self._handler())
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    @property
+    def login_url(self):
+        return self.base_url + "/login"
+
+    @property
+    def probe_endpoint(self):
+        """Drop-in entry for the app's probe_endpoints setting"""
+        return {"url": self.base_url + "/generate_204", "status": 204}
+
+    def login_url_for(self, client):
+        return f"{self.base_url}/c/{client}/login"
+
+    def probe_endpoint_for(self, client):
+        return {"url": f"{self.base_url}/c/{client}/generate_204", "status": 204}
+
+    @property
+    def authenticated_at(self):
+        return self.sessions.get("")
+
+    @authenticated_at.setter
+    def authenticated_at(self, value):
+        if value is None:
+            self.sessions.pop("", None)
+        else:
+            self.sessions[""] = value
+
+    @property
+    def authenticated(self):
+        return self.is_authenticated("")
+
+    def is_authenticated(self, client):
+        authenticated_at = self.sessions.get(client)
+        if authenticated_at is None:
+            return False
+        return self.session_ttl is None or time.monotonic() < authenticated_at + self.session_ttl
+
+    @property
+    def session_expires_at(self):
+        """time.monotonic() when the current session runs out, if it does"""
+        if self.authenticated_at is None or self.session_ttl is None:
+            return None
+        return self.authenticated_at + self.session_ttl
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def issue_token(self):
+        if self.token_mode == "static":
+            return self.static_token
+        token = secrets.token_hex(8)
+        with self.lock:
+            self.tokens.add(token)
+        return token
+
+    def rotate_token(self):
+        """Invalidate the static token, so recorded logins stop working"""
+        self.static_token = secrets.token_hex(8)
+
+    def logout(self, client=""):
+        """End the session - the probe endpoint is intercepted again"""
+        self.sessions.pop(client, None)
+
+    def logout_all(self):
+        self.sessions.clear()
+
+    def allow_login_request(self):
+        """Count a login page load or post against login_rate_limit"""
+        with self.lock:
+            self.login_requests += 1
+            if self.login_rate_limit is None:
+                return True
+            now = time.monotonic()
+            while self.recent_logins and self.recent_logins[0] <= now - 1:
+                self.recent_logins.popleft()
+            if len(self.recent_logins) >= self.login_rate_limit:
+                self.rate_limited += 1
+                return False
+            self.recent_logins.append(now)
+            return True
+
+    def check_login(self, fields, client=""):
+        token = fields.get("token", "")
+        with self.lock:
+            if self.token_mode == "static":
+                if token != self.static_token:
+                    return False
+            elif token not in self.tokens:
+                return False
+            self.tokens.discard(token)
+        if fields.get("username") == self.username and fields.get("password") == self.password:
+            with self.lock:
+                self.logins += 1
+                self.sessions[client] = time.monotonic()
+            return True
+        return False
+
+    def _handler(self):
+        portal = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body go out in separate writes - don't let Nagle stall them
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def send_body(self, status, body, content_type="text/html", headers=None):
+                if portal.delay:
+                    time.sleep(portal.delay)
+                data = body.encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def route(self):
+                """(client, path) - /c/<client>/login is client's /login"""
+                path = urlparse(self.path).path
+                if path.startswith("/c/"):
+                    client, _, rest = path[len("/c/"):].partition("/")
+                    return client, "/" + rest
+                return "", path
+
+            def do_GET(self):
+                client, path = self.route()
+                if path == "/login":
+                    if not portal.allow_login_request():
+                        self.send_body(503, "portal overloaded", "text/plain")
+                        return
+                    form = LOGIN_PAGE.format(token=portal.issue_token())
+                    if portal.js_only:
+                        form = JS_LOGIN_PAGE.format(form=form)
+                    self.send_body(200, form)
+                elif path == "/generate_204":
+                    if portal.is_authenticated(client) or not portal.intercept:
+                        self.send_body(204, "")
+                    else:
+                        login_url = portal.login_url_for(client) if client else portal.login_url
+                        self.send_body(302, "", headers={"Location": login_url})
+                elif path == "/success":
+                    self.send_body(200, SUCCESS_PAGE)
+                else:
+                    self.send_body(404, "not found", "text/plain")
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                fields = {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode("utf-8")).items()}
+                client, path = self.route()
+                if path != "/login":
+                    self.send_body(404, "not found", "text/plain")
+                elif not portal.allow_login_request():
+                    self.send_body(503, "portal overloaded", "text/plain")
+                elif portal.check_login(fields, client):
+                    self.send_body(302, "", headers={"Location": "success"})
+                else:
+                    self.send_body(200, LOGIN_PAGE.format(token=portal.issue_token()))
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--js-only", action="store_true", help="only render the form with JavaScript")
+    parser.add_argument("--token-mode", choices=["one-time", "static"], default="one-time")
+    parser.add_argument("--session-ttl", type=float, help="seconds before a login expires")
+    parser.add_argument("--delay", type=float, default=0, help="seconds to stall every response")
+    parser.add_argument("--login-rate-limit", type=int, help="login requests per second before answering 503")
+    args = parser.parse_args()
+    portal = StubPortal(js_only=args.js_only, token_mode=args.token_mode, session_ttl=args.session_ttl,
+                        delay=args.delay, login_rate_limit=args.login_rate_limit, port=args.port)
+    print(f"Stub portal at {portal.login_url} (student / hunter2)")
+    try:
+        portal.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,265 @@
+"""Local stand-ins for the vendor captive portals the app has adapters for.
+
+Each one copies what matters about the real thing: the redirect a client
+gets (with the vendor's query parameters), the login page markup and the
+fields the login POST has to carry. A login only counts if the request
+looks like the one the vendor's own page sends - Cisco's buttonClicked=4,
+ISE's token, FortiGate's magic and so on. The Cisco pages submit from a
+script like the real ones do, so the generic HTTP login can't use them.
+
+"cisco-custom" is a campus's own login page that happens to look like a
+Cisco WLC (login.html, a redirect parameter, Cisco branding) but has its
+own field names - the adapter gets it wrong and the generic login has to
+take over.
+
+    portal = VendorPortal("fortinet").start()
+    portal.login_url      # redirects to the vendor's login page
+    portal.probe_endpoint # 204 once logged in, redirect to login_url otherwise
+
+Run it directly to poke at one by hand:
+
+    python benchmarks/stub_vendors.py fortinet --port 8080
+"""
+import argparse
+import secrets
+import threading
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlencode, urlparse
+
+from stub_portal import SUCCESS_PAGE, PortalServer
+
+SCRIPT_SUBMIT = '<input type="button" value="Log in" onclick="submitAction();">'
+
+PAGES = {
+    "cisco-wlc": """<html><head><title>Web Authentication</title>
+<script>function submitAction() {{ document.forms[0].buttonClicked.value = 4; document.forms[0].submit(); }}</script>
+</head><body><p>Cisco Systems - Web Authentication</p>
+<form method="post" action="{switch_url}">
+  <input type="hidden" name="buttonClicked" value="0">
+  <input type="hidden" name="err_flag" value="0">
+  <input type="hidden" name="err_msg" value="">
+  <input type="hidden" name="info_flag" value="0">
+  <input type="hidden" name="info_msg" value="">
+  <input type="hidden" name="redirect_url" value="">
+  <input type="hidden" name="network_name" value="Guest Network">
+  User Name <input type="text" name="username">
+  Password <input type="password" name="password">
+  """ + SCRIPT_SUBMIT + """
+</form></body></html>""",
+    "cisco-ise": """<html><body><div class="cisco-ise">
+<form method="post" action="LoginSubmit.action?from=LOGIN" id="portalLoginForm">
+  <input type="hidden" name="token" value="{token}">
+  <input type="text" id="user.username" name="user.username">
+  <input type="password" id="user.password" name="user.password">
+  """ + SCRIPT_SUBMIT + """
+</form></div></body></html>""",
+    "aruba": """<html><body><h1>ClearPass Guest</h1>
+<form method="post" action="{base_url}/cgi-bin/login">
+  <input type="hidden" name="cmd" value="authenticate">
+  <input type="hidden" name="url" value="http://example.com/">
+  <input type="text" name="user">
+  <input type="password" name="password">
+  <input type="submit" value="Log In">
+</form></body></html>""",
+    "fortinet": """<html><body><p>Authentication Required (Fortinet)</p>
+<form action="/" method="post">
+  <input type="hidden" name="4Tredir" value="http://example.com/">
+  <input type="hidden" name="magic" value="{token}">
+  <input type="text" name="username">
+  <input type="password" name="password">
+  <input type="submit" value="Continue">
+</form></body></html>""",
+    "pfsense": """<html><body><h2>pfSense captive portal</h2>
+<form method="post" action="/index.php?zone=lab">
+  <input name="auth_user" type="text">
+  <input name="auth_pass" type="password">
+  <input name="redirurl" type="hidden" value="http://example.com/">
+  <input name="zone" type="hidden" value="lab">
+  <input name="accept" type="submit" value="Login">
+</form></body></html>""",
+    "meraki": """<html><body><h1>Meraki sign-on</h1>
+<form method="post" action="/splash/login?mauth={token}">
+  <input type="hidden" name="continue_url" value="http://example.com/">
+  <input type="email" name="email">
+  <input type="password" name="password">
+  <input type="submit" value="Sign in">
+</form></body></html>""",
+    "cisco-custom": """<html><body><p>Campus WiFi, powered by Cisco</p>
+<form method="post" action="/login.html">
+  <input type="hidden" name="token" value="{token}">
+  Student ID <input type="text" name="uname">
+  Password <input type="password" name="pwd">
+  <input type="submit" value="Sign in">
+</form></body></html>""",
+}
+
+# Portals that look like a vendor's but aren't quite
+CUSTOMISED = ["cisco-custom"]
+VENDORS = sorted(set(PAGES) - set(CUSTOMISED))
+
+
+class VendorPortal:
+    """One vendor's captive portal on a background thread"""
+
+    def __init__(self, vendor, username="student", password="hunter2", port=0):
+        if vendor not in PAGES:
+            raise ValueError(f"Unknown vendor {vendor!r}, pick one of {', '.join(sorted(PAGES))}")
+        self.vendor = vendor
+        self.username = username
+        self.password = password
+        self.token = secrets.token_hex(8)
+        self.authenticated = False
+        self.logins = 0
+        self.login_posts = 0
+        self.lock = threading.Lock()
+        self.server = PortalServer(("127.0.0.1", port), self._handler())
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    @property
+    def login_url(self):
+        """What a captive client gets sent to first - it redirects to the vendor page"""
+        return self.base_url + "/"
+
+    @property
+    def probe_endpoint(self):
+        return {"url": self.base_url + "/generate_204", "status": 204}
+
+    def entry_url(self):
+        """The vendor's login page, with the parameters its redirect adds"""
+        base = self.base_url
+        if self.vendor == "cisco-wlc":
+            return base + "/login.html?" + urlencode({
+                "switch_url": base + "/login.html", "ap_mac": "00:11:22:33:44:55",
+                "client_mac": "66:77:88:99:aa:bb", "wlan": "Guest", "redirect": "example.com/"})
+        if self.vendor == "cisco-ise":
+            return base + "/portal/PortalSetup.action?" + urlencode({"portal": "a1b2", "sessionId": "0a0b0c"})
+        if self.vendor == "aruba":
+            return base + "/guest/lab_login.php?" + urlencode({
+                "cmd": "login", "mac": "66:77:88:99:aa:bb", "essid": "Lab", "url": "http://example.com/"})
+        if self.vendor == "fortinet":
+            return base + "/fgtauth?" + self.token
+        if self.vendor == "cisco-custom":
+            return base + "/login.html?" + urlencode({"redirect": "example.com/"})
+        if self.vendor == "pfsense":
+            return base + "/index.php?" + urlencode({"zone": "lab", "redirurl": "http://example.com/"})
+        return base + "/splash/login?" + urlencode({"mauth": self.token, "continue_url": "http://example.com/"})
+
+    def login_page(self):
+        return PAGES[self.vendor].format(token=self.token, base_url=self.base_url,
+                                         switch_url=self.base_url + "/login.html")
+
+    def accepts(self, path, query, fields):
+        """Is this POST the vendor's login request, with the right credentials?"""
+        def field(name):
+            return fields.get(name, "")
+
+        if self.vendor == "cisco-wlc":
+            ok = path == "/login.html" and field("buttonClicked") == "4"
+            user, password = field("username"), field("password")
+        elif self.vendor == "cisco-ise":
+            ok = (path == "/portal/LoginSubmit.action" and field("token") == self.token
+                  and query.get("from") == ["LOGIN"])
+            user, password = field("user.username"), field("user.password")
+        elif self.vendor == "aruba":
+            ok = path == "/cgi-bin/login" and field("cmd") == "authenticate"
+            user, password = field("user"), field("password")
+        elif self.vendor == "fortinet":
+            ok = path == "/" and field("magic") == self.token
+            user, password = field("username"), field("password")
+        elif self.vendor == "cisco-custom":
+            ok = path == "/login.html" and field("token") == self.token
+            user, password = field("uname"), field("pwd")
+        elif self.vendor == "pfsense":
+            ok = path == "/index.php" and field("zone") == "lab" and field("accept") != ""
+            user, password = field("auth_user"), field("auth_pass")
+        else:
+            ok = path == "/splash/login" and query.get("mauth") == [self.token]
+            user, password = field("email"), field("password")
+        return ok and user == self.username and password == self.password
+
+    def logout(self):
+        self.authenticated = False
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _handler(self):
+        portal = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def send_body(self, status, body, content_type="text/html", headers=None):
+                data = body.encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                entry = urlparse(portal.entry_url())
+                if url.path == "/generate_204":
+                    if portal.authenticated:
+                        self.send_body(204, "")
+                    else:
+                        self.send_body(302, "", headers={"Location": portal.login_url})
+                elif url.path == "/":
+                    self.send_body(302, "", headers={"Location": portal.entry_url()})
+                elif url.path == entry.path:
+                    self.send_body(200, portal.login_page())
+                else:
+                    self.send_body(404, "not found", "text/plain")
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                fields = {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode("utf-8")).items()}
+                url = urlparse(self.path)
+                with portal.lock:
+                    portal.login_posts += 1
+                if portal.accepts(url.path, parse_qs(url.query), fields):
+                    with portal.lock:
+                        portal.logins += 1
+                        portal.authenticated = True
+                    self.send_body(200, SUCCESS_PAGE)
+                else:
+                    # Like the real ones: a failed login lands you back on the login page
+                    self.send_body(200, portal.login_page())
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("vendor", choices=sorted(PAGES))
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+    portal = VendorPortal(args.vendor, port=args.port)
+    print(f"{args.vendor} stand-in at {portal.login_url} (student / hunter2)")
+    try:
+        portal.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -3,66 +3,2740 @@ import time
 import subprocess
 import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
 import logging
+import logging.handlers
+import queue
+import random
 import os
 import json
+import math
+import re
+import hashlib
+import signal
+import socket
+import uuid
+import atexit
+import shutil
 import webbrowser
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import TimeoutException
-from webdriver_manager.chrome import ChromeDriverManager
-from webdriver_manager.core.os_manager import ChromeType
-
-# Bringing in the GUI stuff we need
-import tkinter as tk
-from tkinter import ttk, messagebox
-import rumps  # Need this for the macOS menu bar icon
-
-# Let's set up some decent logging - always helps when debugging later
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(os.path.expanduser("~/Library/Logs/wifi_reconnector.log")),
-        logging.StreamHandler()
-    ]
-)
+from array import array
+from collections import deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from html.parser import HTMLParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urljoin, urlsplit, parse_qsl
+import argparse
+import asyncio
+
+# Selenium, webdriver_manager, tkinter and rumps are slow to import and most runs
+# never touch them (a connectivity check, the headless daemon), so they get
+# imported inside the functions that use them instead of up here.
+
 logger = logging.getLogger(__name__)
 
-# Gotta store our settings somewhere the OS won't mess with
-APP_SUPPORT_DIR = os.path.expanduser("~/Library/Application Support/WiFiReconnector")
-if not os.path.exists(APP_SUPPORT_DIR):
-    os.makedirs(APP_SUPPORT_DIR)
-CONFIG_FILE = os.path.join(APP_SUPPORT_DIR, "wifi_config.json")
+LOG_DIR = os.path.expanduser("~/Library/Logs")
+LOG_FILE = os.path.join(LOG_DIR, "wifi_reconnector.log")
+EVENTS_FILE = os.path.join(LOG_DIR, "wifi_reconnector_events.jsonl")
+
+# Gotta store our settings somewhere the OS won't mess with
+APP_SUPPORT_DIR = os.path.expanduser("~/Library/Application Support/WiFiReconnector")
+CONFIG_FILE = os.path.join(APP_SUPPORT_DIR, "wifi_config.json")
+DRIVER_CACHE_FILE = os.path.join(APP_SUPPORT_DIR, "driver_cache.json")
+SELECTOR_CACHE_FILE = os.path.join(APP_SUPPORT_DIR, "selector_cache.json")
+LOGIN_REPLAY_FILE = os.path.join(APP_SUPPORT_DIR, "login_replay.json")
+CONTROL_SOCKET = os.path.join(APP_SUPPORT_DIR, "control.sock")
+
+# Starting with some sensible defaults
+DEFAULT_CONFIG = {
+    "wifi_name": "",
+    "login_url": "",
+    "username": "",
+    "password": "",
+    "check_interval": 30,
+    # The monitor checks every min_check_interval seconds right after trouble and
+    # backs off towards max_check_interval while things stay stable. Network
+    # change events wake it up straight away regardless.
+    "min_check_interval": 5,
+    "max_check_interval": 120,
+    "auto_start": True,
+    # Which platform commands to use for WiFi - "auto", "macos", "linux" or "fake"
+    "network_backend": "auto",
+    # How long an SSID lookup stays good for (network change events clear it early)
+    "ssid_cache_ttl": 5,
+    # "auto" tries a plain HTTP form post first and only fires up Chrome if the
+    # page needs JavaScript; "http" and "browser" force one engine
+    "auth_engine": "auto",
+    # Remember the login request that worked and just resend it next time
+    "login_replay": True,
+    # Recognise well-known portals (Cisco, Aruba, Fortinet, pfSense, Meraki) and
+    # log in with the request their own login page sends, no guessing at forms
+    "portal_adapters": True,
+    # Optional CSS selector for something only shown once you're logged in
+    "login_success_selector": "",
+    # How long to wait for WiFi to associate, and for a login to get us online
+    "associate_timeout": 15,
+    "auth_verify_timeout": 10,
+    # Keep the headless browser around this long after a login in case we need it again
+    "browser_idle_timeout": 120,
+    # Tiny "is the internet really there" pages - a captive portal will redirect
+    # these or swap in its login page, so we can tell the difference from offline
+    "probe_endpoints": [
+        {"url": "http://connectivitycheck.gstatic.com/generate_204", "status": 204},
+        {"url": "http://captive.apple.com/hotspot-detect.html", "status": 200, "body": "Success"},
+        {"url": "http://www.msftconnecttest.com/connecttest.txt", "status": 200, "body": "Microsoft Connect Test"}
+    ],
+    "probe_timeout": 3,
+    # A probe result this fresh is good enough for anyone else who asks (the GUI, the menu)
+    "probe_cache_ttl": 2,
+    # Shared HTTP connection pool used by the probes and HTTP logins
+    "http_pool_size": 8,
+    "dns_cache_ttl": 60,
+    # Serve /metrics (text) and /metrics.json on 127.0.0.1 at this port - 0 turns it off
+    "metrics_port": 0,
+    # Logs rotate at log_max_bytes, or on a schedule if log_rotate_when is set
+    # (anything TimedRotatingFileHandler takes, like "midnight")
+    "log_max_bytes": 1048576,
+    "log_backup_count": 5,
+    "log_rotate_when": "",
+    # Also write outages, auth results and phase timings as JSON lines
+    "event_log": True,
+    # How many recent log lines to keep in memory for "View Logs"
+    "log_ring_size": 200,
+    # After a failed login or WiFi join, wait retry_base_delay seconds before the
+    # next attempt, doubling each time up to retry_max_delay
+    "retry_base_delay": 5,
+    "retry_max_delay": 300,
+    # Stop logging in after this many failures in a row (or straight away if the
+    # portal rejects the password), then give it one try every auth_breaker_reset seconds
+    "auth_failure_threshold": 5,
+    "auth_breaker_reset": 600,
+    # Sample link quality (a TCP connect to the first probe endpoint) every
+    # quality_sample_interval seconds, keeping the last quality_window samples.
+    # Packet loss or jitter past these limits gets the WiFi rejoined, a slow
+    # link a fresh portal login. 0 turns sampling off.
+    "quality_sample_interval": 5,
+    "quality_window": 60,
+    "quality_max_loss": 0.3,
+    "quality_max_latency_ms": 1500,
+    "quality_max_jitter_ms": 1000,
+    # Learn how long portal sessions last and log in again this many seconds
+    # before one runs out, so it never actually drops (0 turns it off)
+    "session_refresh_lead": 60,
+    # Lab-friendly scheduling, so a room full of machines that all see the same
+    # network blip don't all hit the portal in the same second. The first check
+    # waits a random 0..start_jitter seconds and every wait is stretched or
+    # shrunk by up to schedule_jitter (a fraction). With herd_jitter_window set,
+    # network change events also wait this machine's slot in a window that many
+    # seconds long - the slot comes from host_id (hostname and MAC if empty).
+    "start_jitter": 5,
+    "schedule_jitter": 0.1,
+    "herd_jitter_window": 0,
+    "host_id": "",
+    # Never more than auth_burst logins back to back, refilling at auth_rate_per_minute
+    "auth_burst": 3,
+    "auth_rate_per_minute": 2,
+    # Listen on a Unix socket for status queries and commands (see ControlServer)
+    "control_socket": True,
+    # "thread" is the original monitor loop, "asyncio" runs the SSID check and
+    # connectivity probe side by side (see AsyncMonitor)
+    "engine": "thread",
+    # Seconds each step of an asyncio check gets before it's abandoned
+    "stage_timeouts": {"ssid": 5, "probe": 8, "associate": 30, "auth": 90, "recover": 90}
+}
+
+class BatchedFlushMixin:
+    """Lets the log writer flush once per batch instead of once per line"""
+
+    batching = False
+
+    def flush(self):
+        if not self.batching:
+            super().flush()
+
+
+class BatchedRotatingFileHandler(BatchedFlushMixin, logging.handlers.RotatingFileHandler):
+    pass
+
+
+class BatchedTimedRotatingFileHandler(BatchedFlushMixin, logging.handlers.TimedRotatingFileHandler):
+    pass
+
+
+class EventFilter(logging.Filter):
+    """Only lets through records logged with log_event()"""
+
+    def filter(self, record):
+        return hasattr(record, "event")
+
+
+class JsonEventFormatter(logging.Formatter):
+    def format(self, record):
+        return json.dumps(dict({"time": record.created, "event": record.event}, **record.fields), default=str)
+
+
+class RingBufferHandler(logging.Handler):
+    """Keeps the last few hundred log lines in memory for the UI"""
+
+    def __init__(self, capacity=200):
+        super().__init__()
+        self.buffer = deque(maxlen=capacity)
+
+    def emit(self, record):
+        self.buffer.append({
+            "time": record.created,
+            "level": record.levelname,
+            "message": record.getMessage(),
+            "event": getattr(record, "event", None),
+        })
+
+    def recent(self, count=None):
+        entries = list(self.buffer)
+        return entries[-count:] if count else entries
+
+
+class LogPipeline:
+    """Non-blocking logging: everyone drops records on a queue, and a single
+    writer thread hands them to the real handlers in batches.
+
+    The monitor, Tk and menu bar threads all log, and none of them should ever
+    wait on the disk to do it.
+    """
+
+    STOP = object()
+
+    def __init__(self, handlers, ring=None, batch_size=100):
+        self.handlers = handlers
+        self.ring = ring
+        self.batch_size = batch_size
+        self.queue = queue.SimpleQueue()
+        self.queue_handler = logging.handlers.QueueHandler(self.queue)
+        self.thread = threading.Thread(target=self.write_loop, name="log-writer", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        atexit.register(self.stop)
+        return self
+
+    def write_loop(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = batch[-1] is self.STOP
+            if stopping:
+                batch.pop()
+            self.write(batch)
+            if stopping:
+                return
+
+    def write(self, records):
+        for handler in self.handlers:
+            handler.batching = True
+        try:
+            for record in records:
+                for handler in self.handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+        finally:
+            for handler in self.handlers:
+                handler.batching = False
+                handler.flush()
+
+    def stop(self):
+        """Write out whatever is still queued"""
+        if self.thread.is_alive():
+            self.queue.put(self.STOP)
+            self.thread.join(timeout=5)
+
+    def recent(self, count=None):
+        return self.ring.recent(count) if self.ring else []
+
+
+def setup_logging(config):
+    """Send our logs (and the libraries') through a LogPipeline"""
+    os.makedirs(LOG_DIR, exist_ok=True)
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+
+    def rotating(path):
+        if config["log_rotate_when"]:
+            return BatchedTimedRotatingFileHandler(path, when=config["log_rotate_when"],
+                                                   backupCount=config["log_backup_count"])
+        return BatchedRotatingFileHandler(path, maxBytes=config["log_max_bytes"],
+                                          backupCount=config["log_backup_count"])
+
+    file_handler = rotating(LOG_FILE)
+    stream_handler = logging.StreamHandler()
+    ring = RingBufferHandler(config["log_ring_size"])
+    handlers = [file_handler, stream_handler, ring]
+    for handler in handlers:
+        handler.setLevel(logging.INFO)
+        handler.setFormatter(formatter)
+    if config["event_log"]:
+        events_handler = rotating(EVENTS_FILE)
+        events_handler.setLevel(logging.DEBUG)
+        events_handler.addFilter(EventFilter())
+        events_handler.setFormatter(JsonEventFormatter())
+        handlers.append(events_handler)
+
+    pipeline = LogPipeline(handlers, ring).start()
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(pipeline.queue_handler)
+    # Our own debug records still need to reach the event stream
+    logger.setLevel(logging.DEBUG)
+    return pipeline
+
+
+def log_event(event, level=logging.INFO, **fields):
+    """Log a structured event - goes to the JSONL event stream as well as the normal log"""
+    details = ", ".join(f"{name}={value}" for name, value in fields.items())
+    logger.log(level, f"{event}: {details}" if details else event, extra={"event": event, "fields": fields})
+
+
+# Every site has a different layout, so we try these in order. Both the HTTP
+# and the browser login engines use the same lists so they pick the same fields.
+USERNAME_SELECTORS = ["#username", "[name='username']", "[type='text']", "[type='email']"]
+PASSWORD_SELECTORS = ["#password", "[name='password']", "[type='password']"]
+SUBMIT_SELECTORS = ["[type='submit']", "button", "#loginButton", ".login-button"]
+
+
+def matches_selector(tag, attrs, selector):
+    """Check a parsed element against the simple CSS selectors we use above"""
+    if selector.startswith("#"):
+        return attrs.get("id") == selector[1:]
+    if selector.startswith("."):
+        return selector[1:] in (attrs.get("class") or "").split()
+    match = re.fullmatch(r"\[(\w+)='([^']*)'\]", selector)
+    if match:
+        return attrs.get(match.group(1)) == match.group(2)
+    return tag == selector
+
+
+class LoginFormParser(HTMLParser):
+    """Pulls the forms (and their fields) out of a login page"""
+
+    FIELD_TAGS = ("input", "button", "select", "textarea")
+
+    def __init__(self):
+        super().__init__()
+        self.forms = []
+        self.script_count = 0
+        self._form = None
+        self._select = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = {name: (value if value is not None else "") for name, value in attrs}
+        if tag == "script":
+            self.script_count += 1
+        elif tag == "form":
+            self._form = {"attrs": attrs, "fields": []}
+            self.forms.append(self._form)
+        elif tag in self.FIELD_TAGS and self._form is not None:
+            field = {"tag": tag, "attrs": attrs}
+            self._form["fields"].append(field)
+            if tag == "select":
+                self._select = field
+        elif tag == "option" and self._select is not None:
+            # Browsers submit the selected option, or the first one if none is
+            if "value" not in self._select["attrs"] or "selected" in attrs:
+                self._select["attrs"]["value"] = attrs.get("value", "")
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+
+    def handle_endtag(self, tag):
+        if tag == "form":
+            self._form = None
+        elif tag == "select":
+            self._select = None
+
+    def login_form(self):
+        """Return the first form with a password field in it, if there is one"""
+        for form in self.forms:
+            for field in form["fields"]:
+                if field["tag"] == "input" and field["attrs"].get("type") == "password":
+                    return form
+        return None
+
+
+def find_field(fields, selectors):
+    """Return (selector, field) for the first selector that matches, or (None, None)"""
+    for selector in selectors:
+        for field in fields:
+            if matches_selector(field["tag"], field["attrs"], selector):
+                return selector, field
+    return None, None
+
+
+# Runs in the browser to describe the login form the same way form_fingerprint() does
+FINGERPRINT_JS = """
+var pw = document.querySelector("input[type='password']");
+var scope = (pw && pw.form) || document;
+return Array.prototype.map.call(scope.querySelectorAll("input, button, select, textarea"), function (e) {
+    return [e.tagName.toLowerCase(), e.getAttribute("type") || "", e.getAttribute("name") || "", e.id || ""];
+});
+"""
+
+
+def form_fingerprint(elements):
+    """Cheap hash of a form's structure - (tag, type, name, id) for each field"""
+    text = "|".join(",".join(element) for element in elements)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+def parsed_form_fingerprint(form):
+    return form_fingerprint(
+        (field["tag"], field["attrs"].get("type", ""), field["attrs"].get("name", ""), field["attrs"].get("id", ""))
+        for field in form["fields"])
+
+
+def page_key(login_url):
+    """scheme://host/path of a login page, to remember things about it by"""
+    # Portal redirects tack per-session junk onto the query string, so leave it out
+    parts = urlsplit(login_url)
+    return f"{parts.scheme}://{parts.netloc}{parts.path}"
+
+
+class SelectorCache:
+    """Remembers which selectors worked for each login page.
+
+    Keyed by page_key(), with a fingerprint of the form so a redesigned portal
+    throws its entry away instead of sending us to the wrong fields.
+    """
+
+    FIELDS = ("username", "password", "submit")
+
+    def __init__(self, cache_file=SELECTOR_CACHE_FILE):
+        self.cache_file = cache_file
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        try:
+            with open(cache_file, 'r') as f:
+                # Older versions keyed by the whole URL, query string and all
+                self.entries = {page_key(url): entry for url, entry in json.load(f).items()}
+        except (OSError, ValueError, AttributeError):
+            self.entries = {}
+
+    def lookup(self, login_url, fingerprint):
+        """Return the cached {field: selector} for this page, or None"""
+        key = page_key(login_url)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry.get("fingerprint") != fingerprint:
+                logger.info(f"Login form at {key} changed, forgetting its cached selectors")
+                del self.entries[key]
+                self.save()
+                entry = None
+            if entry:
+                self.hits += 1
+            else:
+                self.misses += 1
+            logger.info(f"Selector cache {'hit' if entry else 'miss'} for {key} "
+                        f"(hits={self.hits}, misses={self.misses})")
+            return entry
+
+    def store(self, login_url, fingerprint, selectors):
+        """Record the selectors that just got us logged in"""
+        key = page_key(login_url)
+        entry = dict(selectors, fingerprint=fingerprint)
+        with self.lock:
+            if self.entries.get(key) == entry:
+                return
+            self.entries[key] = entry
+            self.save()
+
+    def save(self):
+        try:
+            with open(self.cache_file, 'w') as f:
+                json.dump(self.entries, f, indent=4)
+        except OSError as e:
+            logger.warning(f"Could not save selector cache: {e}")
+
+    @staticmethod
+    def ordered(selectors, entry, field):
+        """Put the selector that worked last time at the front of the list"""
+        known = entry.get(field) if entry else None
+        if known:
+            return [known] + [selector for selector in selectors if selector != known]
+        return selectors
+
+
+# Snapshot of the login form as the browser would submit it (fallback when the
+# performance log didn't catch the request)
+CAPTURE_FORM_JS = """
+var form = arguments[0].form;
+if (!form) return null;
+var fields = [];
+new FormData(form).forEach(function (value, name) { fields.push([name, value]); });
+return {url: form.action, method: (form.method || "get").toUpperCase(), fields: fields};
+"""
+
+
+# Why a login failed. Timeouts and network errors are worth retrying, the rest
+# won't fix themselves - the portal changed, or the password is wrong.
+AUTH_TIMEOUT = "timeout"
+AUTH_NETWORK = "network"
+AUTH_FORM_NOT_FOUND = "form_not_found"
+AUTH_REJECTED = "rejected"
+AUTH_CONFIG = "config"
+RETRYABLE_FAILURES = (AUTH_TIMEOUT, AUTH_NETWORK)
+
+AuthResult = namedtuple("AuthResult", ["success", "reason"])
+
+
+def http_failure(status_code):
+    """Why a login POST that came back with an HTTP error failed, as an AUTH_* reason"""
+    if status_code in (401, 403):
+        return AUTH_REJECTED
+    if status_code == 408:
+        return AUTH_TIMEOUT
+    # An overloaded or rate-limiting portal will take us later
+    if status_code == 429 or status_code >= 500:
+        return AUTH_NETWORK
+    # Anything else means we posted somewhere that isn't a login
+    return AUTH_FORM_NOT_FOUND
+
+
+class LoginReplay:
+    """Records the request that logged us in and replays it over plain HTTP.
+
+    Re-logging in is then just one POST instead of a page load or a whole
+    browser. The password is never saved - its field is filled in from the
+    config when replaying. If the portal rotated a token and the replay
+    doesn't get us online, the caller forgets the recording and does a full login.
+    """
+
+    def __init__(self, transport, cache_file=LOGIN_REPLAY_FILE, timeout=10):
+        self.transport = transport
+        self.cache_file = cache_file
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        try:
+            with open(cache_file, 'r') as f:
+                self.recordings = json.load(f)
+        except (OSError, ValueError):
+            self.recordings = {}
+
+    key = staticmethod(page_key)
+
+    def record(self, login_url, method, url, fields, username_field, password_field, cookies=None):
+        """Save a login request - fields is a list of (name, value) pairs"""
+        recording = {
+            "method": method.upper(),
+            "url": url,
+            "fields": [[name, "" if name in (username_field, password_field) else value]
+                       for name, value in fields],
+            "username_field": username_field,
+            "password_field": password_field,
+            "cookies": cookies or {},
+        }
+        with self.lock:
+            self.recordings[self.key(login_url)] = recording
+            self.save()
+        logger.info(f"Recorded login request: {recording['method']} {url}")
+
+    def forget(self, login_url):
+        with self.lock:
+            if self.recordings.pop(self.key(login_url), None) is not None:
+                self.save()
+
+    def replay(self, login_url, username, password):
+        """Resend the recorded login. Returns None if there's nothing recorded,
+        otherwise whether the portal accepted the request (check you're online!)"""
+        recording = self.recordings.get(self.key(login_url))
+        if recording is None:
+            return None
+        fields = []
+        for name, value in recording["fields"]:
+            if name == recording["username_field"]:
+                value = username
+            elif name == recording["password_field"]:
+                value = password
+            fields.append((name, value))
+        try:
+            if recording["method"] == "POST":
+                response = self.transport.post(recording["url"], data=fields, cookies=recording["cookies"],
+                                               timeout=self.timeout)
+            else:
+                response = self.transport.get(recording["url"], params=fields, cookies=recording["cookies"],
+                                              timeout=self.timeout)
+        except requests.RequestException as e:
+            logger.info(f"Replaying login request failed: {e}")
+            return False
+        if response.status_code >= 400:
+            return False
+        # Getting the login form back means the portal said no - no point waiting to go online
+        parser = LoginFormParser()
+        parser.feed(response.text)
+        return parser.login_form() is None
+
+    def save(self):
+        try:
+            with open(self.cache_file, 'w') as f:
+                json.dump(self.recordings, f, indent=4)
+        except OSError as e:
+            logger.warning(f"Could not save login recording: {e}")
+
+
+class HttpFormLogin:
+    """Logs into a captive portal with plain HTTP - no browser needed.
+
+    Most portals are a boring HTML form, so fetching the page, filling in the
+    fields and posting it back is way faster than starting Chrome. If the form
+    looks like it needs JavaScript we give up and let the browser handle it.
+    """
+
+    NEEDS_BROWSER = None
+
+    def __init__(self, transport, selector_cache=None, login_replay=None, timeout=10):
+        self.transport = transport
+        self.selector_cache = selector_cache
+        self.login_replay = login_replay
+        self.timeout = timeout
+        # Why the last login returned False, one of the AUTH_* reasons
+        self.failure = None
+
+    def login(self, login_url, username, password, page=None):
+        """Returns True/False for the login result, or NEEDS_BROWSER.
+        page is the login page if someone already fetched it (anything with .url and .text)."""
+        self.failure = None
+        try:
+            if page is None:
+                page = self.transport.get(login_url, timeout=self.timeout)
+                page.raise_for_status()
+            parser = LoginFormParser()
+            parser.feed(page.text)
+
+            form = parser.login_form()
+            if form is None:
+                # No password field in the raw HTML - it's probably built by a script
+                logger.info("No login form in page HTML, falling back to browser")
+                return self.NEEDS_BROWSER
+            action = form["attrs"].get("action", "")
+            if action.lower().startswith("javascript:") or "onsubmit" in form["attrs"]:
+                logger.info("Login form is submitted by JavaScript, falling back to browser")
+                return self.NEEDS_BROWSER
+
+            fields = form["fields"]
+            fingerprint = parsed_form_fingerprint(form)
+            cached = self.selector_cache.lookup(login_url, fingerprint) if self.selector_cache else None
+            username_selector, username_field = find_field(
+                fields, SelectorCache.ordered(USERNAME_SELECTORS, cached, "username"))
+            password_selector, password_field = find_field(
+                fields, SelectorCache.ordered(PASSWORD_SELECTORS, cached, "password"))
+            submit_selector, submit_button = find_field(
+                fields, SelectorCache.ordered(SUBMIT_SELECTORS, cached, "submit"))
+            if not (username_field and password_field and submit_button):
+                logger.info("Could not find login form elements in page HTML, falling back to browser")
+                return self.NEEDS_BROWSER
+            if not (username_field["attrs"].get("name") and password_field["attrs"].get("name")):
+                # Fields without a name never get submitted - a script must be doing it
+                logger.info("Login fields have no names, falling back to browser")
+                return self.NEEDS_BROWSER
+
+            data = self.form_data(fields, submit_button)
+            data[username_field["attrs"]["name"]] = username
+            data[password_field["attrs"]["name"]] = password
+
+            target = urljoin(page.url, action)
+            method = form["attrs"].get("method", "get").upper()
+            cookies = self.transport.session.cookies.get_dict()
+            if method == "POST":
+                response = self.transport.post(target, data=data, timeout=self.timeout)
+            else:
+                response = self.transport.get(target, params=data, timeout=self.timeout)
+
+            if response.status_code >= 400:
+                logger.error(f"Login form post failed with HTTP {response.status_code}")
+                self.failure = http_failure(response.status_code)
+                return False
+            # If the portal just hands us the login form again, the credentials didn't take
+            result = LoginFormParser()
+            result.feed(response.text)
+            if result.login_form() is not None:
+                logger.error("Portal returned the login form again - check your credentials")
+                self.failure = AUTH_REJECTED
+                return False
+            if self.selector_cache:
+                self.selector_cache.store(login_url, fingerprint, {
+                    "username": username_selector, "password": password_selector, "submit": submit_selector})
+            if self.login_replay:
+                self.login_replay.record(login_url, method, target, list(data.items()),
+                                         username_field["attrs"]["name"], password_field["attrs"]["name"], cookies)
+            return True
+        except requests.RequestException as e:
+            logger.error(f"HTTP login error: {e}")
+            self.failure = AUTH_TIMEOUT if isinstance(e, requests.Timeout) else AUTH_NETWORK
+            return False
+
+    @staticmethod
+    def form_data(fields, submit_button):
+        """Build the data a browser would send, including hidden fields"""
+        data = {}
+        for field in fields:
+            attrs = field["attrs"]
+            name = attrs.get("name")
+            if not name or "disabled" in attrs:
+                continue
+            field_type = attrs.get("type", "").lower()
+            if field["tag"] == "button" or field_type in ("submit", "image", "reset"):
+                # Only the button that was clicked gets sent
+                if field is submit_button:
+                    data[name] = attrs.get("value", "")
+                continue
+            if field_type in ("checkbox", "radio") and "checked" not in attrs:
+                continue
+            data[name] = attrs.get("value", "on" if field_type in ("checkbox", "radio") else "")
+        return data
+
+# What the portal showed us: the final URL, every URL in the redirect chain, the
+# query parameters from all of them, the page itself and its login form (if any)
+PortalPage = namedtuple("PortalPage", ["url", "urls", "params", "text", "form"])
+
+
+def fetch_portal_page(transport, login_url, timeout=10):
+    """Load the login page, keeping hold of the redirects that led there"""
+    response = transport.get(login_url, timeout=timeout)
+    response.raise_for_status()
+    urls = [previous.url for previous in response.history] + [response.url]
+    params = {}
+    for url in urls:
+        for name, value in parse_qsl(urlsplit(url).query, keep_blank_values=True):
+            params.setdefault(name, value)
+    parser = LoginFormParser()
+    parser.feed(response.text)
+    form = parser.login_form() or (parser.forms[0] if parser.forms else None)
+    return PortalPage(response.url, urls, params, response.text, form)
+
+
+PORTAL_ADAPTERS = []
+
+
+def register_portal_adapter(cls):
+    """Class decorator - adds an adapter to the ones identify_portal() tries"""
+    PORTAL_ADAPTERS.append(cls())
+    return cls
+
+
+class PortalAdapter:
+    """Logs into one vendor's captive portal with the request its own login page sends.
+
+    A subclass says how to recognise the portal and what to send. URL_PATTERNS
+    are regexes tried against every URL in the redirect chain (worth 2 points
+    each), PARAMS are query parameters the vendor's redirect adds and MARKERS
+    are lowercase strings in the page (1 point each). A portal has to score
+    MIN_SCORE for the adapter to be used. login_request() returns (url, fields)
+    for the login POST, or None if the page isn't what the adapter expected.
+    """
+
+    name = None
+    URL_PATTERNS = ()
+    PARAMS = ()
+    MARKERS = ()
+    USERNAME_FIELD = "username"
+    PASSWORD_FIELD = "password"
+    MIN_SCORE = 4
+
+    def score(self, page):
+        url_hits = sum(1 for pattern in self.URL_PATTERNS
+                       if any(re.search(pattern, url, re.IGNORECASE) for url in page.urls))
+        param_hits = sum(1 for name in self.PARAMS if name in page.params)
+        text = page.text.lower()
+        marker_hits = sum(1 for marker in self.MARKERS if marker in text)
+        return 2 * url_hits + param_hits + marker_hits
+
+    def login_request(self, page, username, password):
+        raise NotImplementedError
+
+    @staticmethod
+    def hidden_fields(page):
+        """The login form's hidden inputs - session tokens and such - as a dict"""
+        if page.form is None:
+            return {}
+        return {field["attrs"]["name"]: field["attrs"].get("value", "") for field in page.form["fields"]
+                if field["tag"] == "input" and field["attrs"].get("type", "").lower() == "hidden"
+                and field["attrs"].get("name")}
+
+    @staticmethod
+    def form_action(page, default):
+        """Where the login form posts to, or default (relative to the page) if it doesn't say"""
+        action = page.form["attrs"].get("action") if page.form else None
+        return urljoin(page.url, action or default)
+
+
+@register_portal_adapter
+class CiscoWlcAdapter(PortalAdapter):
+    """Cisco wireless controller web auth (login.html on the controller's virtual IP)"""
+
+    name = "cisco-wlc"
+    URL_PATTERNS = (r"/login\.html", r"[?&]switch_url=")
+    PARAMS = ("switch_url", "ap_mac", "client_mac", "wlan", "redirect")
+    MARKERS = ("buttonclicked", "err_flag", "cisco")
+
+    def login_request(self, page, username, password):
+        fields = self.hidden_fields(page)
+        # The login button's script sets buttonClicked to 4 before submitting
+        fields.update(buttonClicked="4", username=username, password=password)
+        fields.setdefault("redirect_url", page.params.get("redirect", ""))
+        return self.form_action(page, page.params.get("switch_url") or "login.html"), fields
+
+
+@register_portal_adapter
+class CiscoIseAdapter(PortalAdapter):
+    """Cisco ISE guest and sponsored portals"""
+
+    name = "cisco-ise"
+    URL_PATTERNS = (r"/portal/PortalSetup\.action", r":8443/portal/")
+    PARAMS = ("portal", "sessionId", "action")
+    MARKERS = ("user.username", "loginsubmit.action", "cisco")
+    USERNAME_FIELD = "user.username"
+    PASSWORD_FIELD = "user.password"
+
+    def login_request(self, page, username, password):
+        fields = self.hidden_fields(page)
+        if "token" not in fields:
+            # Every ISE login carries the page's token - without it we'd just get the page back
+            return None
+        for name in ("portal", "sessionId"):
+            if name in page.params:
+                fields.setdefault(name, page.params[name])
+        fields.update({"user.username": username, "user.password": password})
+        return self.form_action(page, "LoginSubmit.action?from=LOGIN"), fields
+
+
+@register_portal_adapter
+class ArubaAdapter(PortalAdapter):
+    """Aruba controllers and ClearPass guest pages - both log in through the controller's /cgi-bin/login"""
+
+    name = "aruba"
+    URL_PATTERNS = (r"/cgi-bin/login", r"/guest/[^/?]+\.php", r"securelogin\.arubanetworks\.com")
+    PARAMS = ("switchip", "essid", "apname", "mac", "cmd")
+    MARKERS = ("aruba", "clearpass", "cgi-bin/login")
+    USERNAME_FIELD = "user"
+
+    def login_request(self, page, username, password):
+        fields = self.hidden_fields(page)
+        fields.update(user=username, password=password, cmd="authenticate")
+        fields.setdefault("url", page.params.get("url", ""))
+        if page.form is None and page.params.get("switchip"):
+            return f"https://{page.params['switchip']}/cgi-bin/login", fields
+        return self.form_action(page, "/cgi-bin/login"), fields
+
+
+@register_portal_adapter
+class FortinetAdapter(PortalAdapter):
+    """FortiGate captive portal (/fgtauth on port 1000 or 1003)"""
+
+    name = "fortinet"
+    URL_PATTERNS = (r"/fgtauth", r":100[03]/")
+    MARKERS = ('name="magic"', "4tredir", "fortinet", "fgtauth")
+
+    def login_request(self, page, username, password):
+        fields = self.hidden_fields(page)
+        if not fields.get("magic"):
+            # The magic is the bare query string of the /fgtauth URL
+            magic = next((urlsplit(url).query for url in page.urls if "/fgtauth" in url), "")
+            if not magic:
+                return None
+            fields["magic"] = magic
+        fields.update(username=username, password=password)
+        return self.form_action(page, "/"), fields
+
+
+@register_portal_adapter
+class PfSenseAdapter(PortalAdapter):
+    """pfSense (and OPNsense-alike) captive portal zones"""
+
+    name = "pfsense"
+    URL_PATTERNS = (r":800[23]/", r"/index\.php")
+    PARAMS = ("zone", "redirurl")
+    MARKERS = ("auth_user", "auth_pass", "pfsense")
+    USERNAME_FIELD = "auth_user"
+    PASSWORD_FIELD = "auth_pass"
+
+    def login_request(self, page, username, password):
+        fields = self.hidden_fields(page)
+        for name in ("zone", "redirurl"):
+            if name in page.params:
+                fields.setdefault(name, page.params[name])
+        fields.update(auth_user=username, auth_pass=password, accept="Login")
+        zone = fields.get("zone", "")
+        return self.form_action(page, f"index.php?zone={zone}" if zone else "index.php"), fields
+
+
+@register_portal_adapter
+class MerakiAdapter(PortalAdapter):
+    """Meraki sign-on splash pages (n123.network-auth.com/splash/login)"""
+
+    name = "meraki"
+    URL_PATTERNS = (r"network-auth\.com", r"/splash/(login|grant)")
+    PARAMS = ("mauth", "continue_url", "base_grant_url", "node_mac")
+    MARKERS = ("meraki", "mauth")
+    USERNAME_FIELD = "email"
+
+    def login_request(self, page, username, password):
+        fields = self.hidden_fields(page)
+        fields.update(email=username, password=password)
+        if "continue_url" in page.params:
+            fields.setdefault("continue_url", page.params["continue_url"])
+        default = f"/splash/login?mauth={page.params['mauth']}" if "mauth" in page.params else "/splash/login"
+        return self.form_action(page, default), fields
+
+
+def identify_portal(page, adapters=None):
+    """Return (adapter, score) for the best matching vendor adapter, or (None, 0)"""
+    best, best_score = None, 0
+    for adapter in PORTAL_ADAPTERS if adapters is None else adapters:
+        score = adapter.score(page)
+        if score >= adapter.MIN_SCORE and score > best_score:
+            best, best_score = adapter, score
+    return best, best_score
+
+
+class VendorLogin:
+    """Logs in through a vendor adapter when the portal is one we recognise.
+
+    Same contract as HttpFormLogin, except NOT_RECOGNISED means the portal
+    isn't a known vendor - page then holds the fetched login page, so the
+    generic login doesn't have to load it again.
+    """
+
+    NOT_RECOGNISED = None
+
+    def __init__(self, transport, adapters=None, login_replay=None, timeout=10):
+        self.transport = transport
+        self.adapters = adapters
+        self.login_replay = login_replay
+        self.timeout = timeout
+        self.failure = None
+        self.adapter = None
+        self.page = None
+
+    def login(self, login_url, username, password):
+        """Returns True/False for the login result, or NOT_RECOGNISED"""
+        self.failure = self.adapter = self.page = None
+        try:
+            self.page = fetch_portal_page(self.transport, login_url, self.timeout)
+            adapter, score = identify_portal(self.page, self.adapters)
+            if adapter is None:
+                return self.NOT_RECOGNISED
+            request = adapter.login_request(self.page, username, password)
+            if request is None:
+                logger.info(f"Portal looks like {adapter.name} but the page isn't what we expected, "
+                            "using the generic login")
+                return self.NOT_RECOGNISED
+            self.adapter = adapter
+            log_event("portal_identified", vendor=adapter.name, score=score, url=self.page.url)
+
+            url, fields = request
+            cookies = self.transport.session.cookies.get_dict()
+            response = self.transport.post(url, data=fields, timeout=self.timeout)
+            if response.status_code >= 400:
+                logger.error(f"{adapter.name} login failed with HTTP {response.status_code}")
+                self.failure = http_failure(response.status_code)
+                return False
+            result = LoginFormParser()
+            result.feed(response.text)
+            if result.login_form() is not None:
+                logger.error("Portal returned the login form again - check your credentials")
+                self.failure = AUTH_REJECTED
+                return False
+            if self.login_replay:
+                self.login_replay.record(login_url, "POST", url, list(fields.items()),
+                                         adapter.USERNAME_FIELD, adapter.PASSWORD_FIELD, cookies)
+            return True
+        except requests.RequestException as e:
+            logger.error(f"HTTP login error: {e}")
+            self.failure = AUTH_TIMEOUT if isinstance(e, requests.Timeout) else AUTH_NETWORK
+            return False
+
+
+def wait_until(condition, timeout, interval=0.1, max_interval=1.0, backoff=1.5, cancel=None):
+    """Poll condition() until it's truthy or timeout seconds pass.
+
+    Returns the truthy value as soon as we see it, or False on timeout. Polls
+    quickly at first and backs off, so fast networks don't wait around but slow
+    ones aren't hammered. Set the cancel event to give up early.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        result = condition()
+        if result:
+            return result
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        delay = min(interval, remaining)
+        if cancel is not None:
+            if cancel.wait(delay):
+                return False
+        else:
+            time.sleep(delay)
+        interval = min(interval * backoff, max_interval)
+
+
+class SingleFlight:
+    """Makes sure only one call to func runs at a time.
+
+    Anyone calling while it's already running waits for that call and gets its
+    result, rather than starting their own - so the GUI, the menu and the
+    monitor asking at once means one probe, or one browser login, not three.
+    The result is reused for ttl seconds afterwards unless the caller asks for
+    a fresh one. Arguments only matter to whoever actually gets to run it.
+    """
+
+    def __init__(self, func, ttl=0):
+        self.func = func
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.in_flight = None
+        # (value, monotonic time) - swapped as a whole, so reading it needs no lock
+        self.latest = None
+        self.stats = {"calls": 0, "runs": 0, "shared": 0, "cached": 0}
+
+    def __call__(self, *args, fresh=False):
+        with self.lock:
+            self.stats["calls"] += 1
+            latest = self.latest
+            if not fresh and latest is not None and time.monotonic() - latest[1] < self.ttl:
+                self.stats["cached"] += 1
+                return latest[0]
+            future = self.in_flight
+            if future is not None:
+                self.stats["shared"] += 1
+                leader = False
+            else:
+                future = self.in_flight = Future()
+                self.stats["runs"] += 1
+                leader = True
+        if not leader:
+            return future.result()
+
+        try:
+            value = self.func(*args)
+        except BaseException as e:
+            with self.lock:
+                self.in_flight = None
+            future.set_exception(e)
+            raise
+        with self.lock:
+            self.latest = (value, time.monotonic())
+            self.in_flight = None
+        future.set_result(value)
+        return value
+
+    def invalidate(self, *args):
+        """Forget the cached result, e.g. because the network just changed"""
+        self.latest = None
+
+
+class RetryPolicy:
+    """Exponential backoff with jitter for one kind of action.
+
+    After a failure the next attempt has to wait base * multiplier^(failures - 1)
+    seconds, capped at max_delay, minus a random part of up to `jitter` of it so
+    retries don't all line up. A success resets it.
+    """
+
+    def __init__(self, name, base=5, max_delay=300, multiplier=2, jitter=0.5):
+        self.name = name
+        self.base = base
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.failures = 0
+        self.next_attempt = 0
+
+    def ready(self):
+        return time.monotonic() >= self.next_attempt
+
+    def retry_in(self):
+        return max(0, self.next_attempt - time.monotonic())
+
+    def record(self, success, reason=None):
+        if success:
+            self.reset()
+            return
+        self.failures += 1
+        delay = min(self.base * self.multiplier ** (self.failures - 1), self.max_delay)
+        delay *= 1 - random.uniform(0, self.jitter)
+        self.next_attempt = time.monotonic() + delay
+        logger.info(f"{self.name} failed ({reason or 'unknown'}), not trying again for {delay:.0f}s")
+
+    def reset(self):
+        self.failures = 0
+        self.next_attempt = 0
+
+    def status(self):
+        return {"failures": self.failures, "retry_in": round(self.retry_in(), 1)}
+
+
+# Circuit breaker states
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitBreaker:
+    """Stops us retrying something that keeps failing.
+
+    Opens after `threshold` failures in a row, or straight away on a failure
+    retrying can't fix (like the portal turning down the password). While it's
+    open every attempt is refused. After reset_timeout it goes half-open and lets
+    one attempt through - success closes it again, failure re-opens it.
+    """
+
+    def __init__(self, name, threshold=5, reset_timeout=600):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """Whether an attempt may go ahead right now"""
+        with self.lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.set_state(HALF_OPEN)
+            return self.state != OPEN
+
+    def record(self, success, retryable=True):
+        with self.lock:
+            if success:
+                self.failures = 0
+                if self.state != CLOSED:
+                    self.set_state(CLOSED)
+                return
+            self.failures += 1
+            if self.state == HALF_OPEN or not retryable or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+                if self.state != OPEN:
+                    self.set_state(OPEN)
+
+    def reset(self):
+        with self.lock:
+            self.failures = 0
+            if self.state != CLOSED:
+                self.set_state(CLOSED)
+
+    def set_state(self, state):
+        self.state = state
+        log_event("circuit_breaker", level=logging.WARNING if state == OPEN else logging.INFO,
+                  breaker=self.name, state=state, failures=self.failures)
+
+    def status(self):
+        status = {"state": self.state, "failures": self.failures}
+        if self.state == OPEN:
+            status["half_open_in"] = round(max(0, self.opened_at + self.reset_timeout - time.monotonic()), 1)
+        return status
+
+
+class TokenBucket:
+    """Rate limit - up to `burst` actions back to back, then `rate` per second"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        """Use up a token if there is one"""
+        with self.lock:
+            self.refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    def status(self):
+        with self.lock:
+            self.refill()
+            return {"tokens": round(self.tokens, 2), "burst": self.burst}
+
+
+class DnsCache:
+    """Tiny TTL cache in front of socket.getaddrinfo.
+
+    Resolving the same handful of probe hosts every few seconds is wasted work,
+    but captive portals lie about DNS until you log in - so this gets flushed
+    whenever the network changes or we authenticate. Only the connections of
+    the HttpTransport that owns it look things up here (see DnsCachingAdapter),
+    nothing else in the process is affected.
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0):
+        key = (host, port, family, type, proto, flags)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        # Failures aren't cached - they raise straight through
+        result = socket.getaddrinfo(host, port, family, type, proto, flags)
+        with self.lock:
+            self.entries[key] = (now + self.ttl, result)
+        return result
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class DnsCachedConnectionMixin:
+    """urllib3 connection that looks its host up in a DnsCache.
+
+    Tries each cached address in turn, handing urllib3 the IP to connect to -
+    the Host header, SNI and certificate checks still use the real hostname.
+    """
+
+    dns = None
+
+    def _new_conn(self):
+        host = self._dns_host
+        try:
+            addresses = self.dns.getaddrinfo(host, self.port, 0, socket.SOCK_STREAM)
+        except OSError as e:
+            raise NewConnectionError(self, f"Failed to resolve {host}: {e}") from e
+        error = None
+        for *_, address in addresses:
+            self._dns_host = address[0]
+            try:
+                return super()._new_conn()
+            except (NewConnectionError, ConnectTimeoutError) as e:
+                error = e
+            finally:
+                self._dns_host = host
+        raise error
+
+
+class DnsCachingAdapter(HTTPAdapter):
+    """HTTPAdapter whose connections resolve hostnames through a DnsCache"""
+
+    def __init__(self, dns, **kwargs):
+        self.dns = dns
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        pools = {}
+        for scheme, pool_class, connection_class in (("http", HTTPConnectionPool, HTTPConnection),
+                                                     ("https", HTTPSConnectionPool, HTTPSConnection)):
+            connection = type(f"DnsCached{connection_class.__name__}",
+                              (DnsCachedConnectionMixin, connection_class), {"dns": self.dns})
+            pools[scheme] = type(f"DnsCached{pool_class.__name__}", (pool_class,), {"ConnectionCls": connection})
+        self.poolmanager.pool_classes_by_scheme = pools
+
+
+class HttpTransport:
+    """One shared, pooled requests session for all our HTTP traffic.
+
+    Keeps connections alive between checks so we skip the TCP/TLS handshakes,
+    and puts a small DNS cache in front of it. Call invalidate() when the WiFi
+    association changes - pooled sockets and cached addresses are useless then.
+    """
+
+    def __init__(self, pool_size=8, timeout=5, dns_ttl=60):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.dns = DnsCache(ttl=dns_ttl)
+        self.lock = threading.Lock()
+        self._session = None
+
+    @property
+    def session(self):
+        with self.lock:
+            if self._session is None:
+                session = requests.Session()
+                pool = dict(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=0)
+                adapter = DnsCachingAdapter(self.dns, **pool) if self.dns.ttl > 0 else HTTPAdapter(**pool)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._session = session
+            return self._session
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.post(url, **kwargs)
+
+    def invalidate(self):
+        """Drop pooled connections, cookies and cached DNS answers"""
+        with self.lock:
+            session, self._session = self._session, None
+        if session is not None:
+            session.close()
+        self.dns.clear()
+
+    def close(self):
+        self.invalidate()
+
+
+class NetworkBackend:
+    """Everything platform specific about WiFi lives behind this.
+
+    Subclasses implement link_command(), join() and discover_interface(). SSID
+    lookups are cached for ssid_cache_ttl seconds because they mean spawning a
+    process - call invalidate() when the association changes. The *_async
+    methods are the same lookups for the asyncio engine.
+    """
+
+    def __init__(self, ssid_cache_ttl=5):
+        self.ssid_cache_ttl = ssid_cache_ttl
+        self.cached_link = None
+        self.cached_at = 0
+        self._interface = None
+        self.spawns = 0
+        self.lock = threading.Lock()
+
+    def run(self, argv, timeout=10):
+        """Run a command (no shell) and return its output"""
+        self.spawns += 1
+        return subprocess.run(argv, capture_output=True, text=True, timeout=timeout).stdout
+
+    async def run_async(self, argv, timeout=10):
+        """run() without blocking the event loop - the process gets killed if it overruns"""
+        self.spawns += 1
+        process = await asyncio.create_subprocess_exec(
+            *argv, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        try:
+            stdout, _ = await asyncio.wait_for(process.communicate(), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            process.kill()
+            await process.wait()
+            raise
+        return stdout.decode("utf-8", "replace")
+
+    def interface(self):
+        """The WiFi interface name, looked up once"""
+        if self._interface is None:
+            self._interface = self.discover_interface()
+        return self._interface
+
+    def link_info(self, fresh=False):
+        """Current association as a dict with ssid, bssid and rssi (any may be None)"""
+        with self.lock:
+            now = time.monotonic()
+            if fresh or self.cached_link is None or now - self.cached_at > self.ssid_cache_ttl:
+                self.cached_link = self.query_link()
+                self.cached_at = now
+            return self.cached_link
+
+    def current_ssid(self, fresh=False):
+        return self.link_info(fresh).get("ssid")
+
+    async def link_info_async(self, fresh=False):
+        now = time.monotonic()
+        if not fresh and self.cached_link is not None and now - self.cached_at <= self.ssid_cache_ttl:
+            return self.cached_link
+        link = await self.query_link_async()
+        with self.lock:
+            self.cached_link = link
+            self.cached_at = time.monotonic()
+        return link
+
+    async def current_ssid_async(self, fresh=False):
+        return (await self.link_info_async(fresh)).get("ssid")
+
+    def associate(self, ssid):
+        """Ask the OS to join a network. Doesn't wait for it to finish."""
+        self.invalidate()
+        return self.join(ssid)
+
+    def invalidate(self, *args):
+        with self.lock:
+            self.cached_link = None
+
+    def query_link(self):
+        command = self.link_command()
+        if command is None:
+            return {"ssid": None, "bssid": None, "rssi": None}
+        argv, parse = command
+        return parse(self.run(argv))
+
+    async def query_link_async(self):
+        command = self.link_command()
+        if command is None:
+            return {"ssid": None, "bssid": None, "rssi": None}
+        argv, parse = command
+        return parse(await self.run_async(argv))
+
+    def link_command(self):
+        """(argv, parse) - the command that reports the current association and
+        a function turning its output into a link dict. None if there isn't one."""
+        raise NotImplementedError
+
+    def join(self, ssid):
+        raise NotImplementedError
+
+    def discover_interface(self):
+        raise NotImplementedError
+
+
+class MacOSBackend(NetworkBackend):
+    """The original macOS commands - airport for status, networksetup to connect"""
+
+    # This is the macOS magic to get WiFi info - had to dig for this one!
+    AIRPORT = "/System/Library/PrivateFrameworks/Apple80211.framework/Versions/Current/Resources/airport"
+
+    def link_command(self):
+        if not os.path.exists(self.AIRPORT):
+            # Newer macOS dropped airport, networksetup can still tell us the SSID
+            return ["networksetup", "-getairportnetwork", self.interface()], self.parse_networksetup
+        return [self.AIRPORT, "-I"], self.parse_airport
+
+    @staticmethod
+    def parse_networksetup(output):
+        ssid = output.split(": ", 1)[1].strip() if output.startswith("Current Wi-Fi Network: ") else None
+        return {"ssid": ssid, "bssid": None, "rssi": None}
+
+    @staticmethod
+    def parse_airport(output):
+        fields = {}
+        for line in output.splitlines():
+            key, sep, value = line.strip().partition(": ")
+            if sep:
+                fields[key] = value.strip()
+        rssi = fields.get("agrCtlRSSI")
+        return {
+            "ssid": fields.get("SSID") or None,
+            "bssid": fields.get("BSSID") or None,
+            "rssi": int(rssi) if rssi and rssi.lstrip("-").isdigit() else None,
+        }
+
+    def join(self, ssid):
+        # Let macOS do the heavy lifting of connecting us
+        output = self.run(["networksetup", "-setairportnetwork", self.interface(), ssid], timeout=30)
+        # networksetup exits 0 even when it fails, but it does print something
+        return "Error" not in output and "Could not find" not in output
+
+    def discover_interface(self):
+        port = None
+        for line in self.run(["networksetup", "-listallhardwareports"]).splitlines():
+            if line.startswith("Hardware Port: "):
+                port = line.split(": ", 1)[1]
+            elif line.startswith("Device: ") and port in ("Wi-Fi", "AirPort"):
+                return line.split(": ", 1)[1].strip()
+        return "en0"
+
+
+class LinuxBackend(NetworkBackend):
+    """NetworkManager (nmcli) when it's there, falling back to iw and sysfs"""
+
+    def link_command(self):
+        if shutil.which("nmcli"):
+            return ["nmcli", "-t", "-f", "ACTIVE,SSID,BSSID,SIGNAL", "dev", "wifi", "list", "--rescan", "no"], self.parse_nmcli
+        if shutil.which("iw"):
+            return ["iw", "dev", self.interface(), "link"], self.parse_iw
+        logger.warning("Neither nmcli nor iw is installed, can't tell which network we're on")
+        return None
+
+    @staticmethod
+    def parse_nmcli(output):
+        for line in output.splitlines():
+            # Terse mode escapes the colons inside values, like the ones in the BSSID
+            fields = [field.replace("\\:", ":") for field in re.split(r"(?<!\\):", line)]
+            if len(fields) == 4 and fields[0] == "yes":
+                signal_pct = int(fields[3]) if fields[3].isdigit() else None
+                return {
+                    "ssid": fields[1] or None,
+                    "bssid": fields[2] or None,
+                    # nmcli gives a percentage, turn it back into a rough dBm
+                    "rssi": signal_pct // 2 - 100 if signal_pct is not None else None,
+                }
+        return {"ssid": None, "bssid": None, "rssi": None}
+
+    @staticmethod
+    def parse_iw(output):
+        link = {"ssid": None, "bssid": None, "rssi": None}
+        for line in output.splitlines():
+            line = line.strip()
+            if line.startswith("Connected to "):
+                link["bssid"] = line.split()[2]
+            elif line.startswith("SSID: "):
+                link["ssid"] = line[len("SSID: "):]
+            elif line.startswith("signal: "):
+                link["rssi"] = int(line.split()[1])
+        return link
+
+    def join(self, ssid):
+        if not shutil.which("nmcli"):
+            logger.error("Joining a network on Linux needs NetworkManager (nmcli)")
+            return False
+        argv = ["nmcli", "dev", "wifi", "connect", ssid, "ifname", self.interface()]
+        self.spawns += 1
+        return subprocess.run(argv, capture_output=True, timeout=30).returncode == 0
+
+    def discover_interface(self):
+        try:
+            for name in sorted(os.listdir("/sys/class/net")):
+                if os.path.isdir(os.path.join("/sys/class/net", name, "wireless")):
+                    return name
+        except OSError:
+            pass
+        return "wlan0"
+
+
+class FakeBackend(NetworkBackend):
+    """In-memory WiFi for tests and benchmarks - script it with set_link()"""
+
+    def __init__(self, ssid=None, ssid_cache_ttl=0, join_delay=0, join_succeeds=True):
+        super().__init__(ssid_cache_ttl)
+        self.link = {"ssid": ssid, "bssid": "02:00:00:00:00:01" if ssid else None, "rssi": -50 if ssid else None}
+        self.join_delay = join_delay
+        self.join_succeeds = join_succeeds
+        self.queries = 0
+        self.joins = 0
+
+    def set_link(self, ssid, bssid="02:00:00:00:00:01", rssi=-50):
+        """Pretend we've (dis)associated - pass None to drop off the network"""
+        self.link = {"ssid": ssid, "bssid": bssid if ssid else None, "rssi": rssi if ssid else None}
+        self.invalidate()
+
+    def query_link(self):
+        self.queries += 1
+        return dict(self.link)
+
+    async def query_link_async(self):
+        return self.query_link()
+
+    def join(self, ssid):
+        self.joins += 1
+        if not self.join_succeeds:
+            return False
+        if self.join_delay:
+            # Associating takes a while in real life too
+            threading.Timer(self.join_delay, self.set_link, args=(ssid,)).start()
+        else:
+            self.set_link(ssid)
+        return True
+
+    def discover_interface(self):
+        return "fake0"
+
+
+def make_backend(name="auto", ssid_cache_ttl=5):
+    """Pick the NetworkBackend for this machine (or the one the config asks for)"""
+    if name == "auto":
+        name = "macos" if sys.platform == "darwin" else "linux"
+    backends = {"macos": MacOSBackend, "linux": LinuxBackend, "fake": FakeBackend}
+    if name not in backends:
+        raise ValueError(f"Unknown network backend: {name}")
+    return backends[name](ssid_cache_ttl=ssid_cache_ttl)
+
+
+class NetworkEventSource:
+    """Something that can tell the scheduler the network just changed"""
+
+    def start(self, callback):
+        self.callback = callback
+
+    def stop(self):
+        pass
+
+
+class FakeEventSource(NetworkEventSource):
+    """Event source you trigger by hand - handy for tests and benchmarks"""
+
+    def __init__(self):
+        self.callback = None
+
+    def trigger(self, reason="fake"):
+        if self.callback:
+            self.callback(reason)
+
+
+class CommandEventSource(NetworkEventSource):
+    """Watches a long-running command that prints a line per network change.
+
+    On Linux that's `ip monitor` (netlink), on macOS `route -n monitor`.
+    """
+
+    def __init__(self, argv):
+        self.argv = argv
+        self.process = None
+        self.thread = None
+
+    def start(self, callback):
+        self.callback = callback
+        self.process = subprocess.Popen(self.argv, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self.thread = threading.Thread(target=self.read_events, daemon=True)
+        self.thread.start()
+
+    def read_events(self):
+        for line in self.process.stdout:
+            if line.strip():
+                self.callback(self.argv[0])
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=1)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+
+def default_event_sources():
+    """Pick the network change watcher for this platform, if it's installed"""
+    if sys.platform.startswith("linux") and shutil.which("ip"):
+        return [CommandEventSource(["ip", "monitor", "link", "address", "route"])]
+    if sys.platform == "darwin" and shutil.which("route"):
+        return [CommandEventSource(["route", "-n", "monitor"])]
+    return []
+
+
+def host_slot(window, host_id=""):
+    """This machine's offset into a jitter window - always the same for the same
+    machine, but spread evenly across a lab of them"""
+    host_id = host_id or f"{socket.gethostname()}-{uuid.getnode():012x}"
+    digest = hashlib.sha256(host_id.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") / 2 ** 64 * window
+
+
+class SessionTracker:
+    """Learns how long the portal's sessions last, so we can log in again before one runs out.
+
+    When a session we logged in ends with the portal intercepting us again, its
+    lifetime goes in the history - counted only up to the last time we saw it
+    working, so the estimate errs on the early side. Once there are a couple of
+    samples, refresh_due() says it's time to log in again: `lead` seconds (but at
+    most a fifth of the session) before the median lifetime is up. If logging in
+    early turns out not to extend the session, it stops trying.
+    """
+
+    MIN_SAMPLES = 2
+
+    def __init__(self, lead=60, history=10):
+        self.lead = lead
+        self.lifetimes = deque(maxlen=history)
+        self.started_at = None
+        # When the session before a refresh started - used if the refresh didn't extend it
+        self.original_start = None
+        self.last_online = None
+        self.refresh_pending = False
+        self.refreshed = False
+        self.attempted = None
+        self.enabled = True
+        self.lock = threading.Lock()
+
+    def started(self):
+        """We just logged in"""
+        with self.lock:
+            now = time.monotonic()
+            if self.refresh_pending and self.started_at is not None:
+                self.original_start = self.original_start or self.started_at
+                self.refreshed = True
+            else:
+                self.original_start = None
+                self.refreshed = False
+            self.refresh_pending = False
+            self.started_at = self.last_online = now
+
+    def seen_online(self):
+        with self.lock:
+            if self.started_at is not None:
+                self.last_online = time.monotonic()
+
+    def expired(self):
+        """The portal is intercepting us again while we're still on the WiFi"""
+        with self.lock:
+            if self.started_at is None:
+                return
+            start = self.started_at
+            if self.refreshed and time.monotonic() < self.refresh_at_locked():
+                # It ran out on the original schedule, so logging in again didn't reset the clock
+                logger.info("Logging in early didn't extend the portal session, not doing that any more")
+                self.enabled = False
+                start = self.original_start
+            lifetime = self.last_online - start
+            self.lifetimes.append(lifetime)
+            self.started_at = self.original_start = None
+            self.refreshed = False
+        log_event("session_expired", lifetime=round(lifetime, 1), estimate=self.estimate())
+
+    def reset(self):
+        """We lost the WiFi - whatever happens to the session now isn't it expiring"""
+        with self.lock:
+            self.started_at = self.original_start = None
+            self.refreshed = self.refresh_pending = False
+
+    def estimate(self):
+        """Median session lifetime in seconds, or None until there's enough history"""
+        if len(self.lifetimes) < self.MIN_SAMPLES:
+            return None
+        return sorted(self.lifetimes)[len(self.lifetimes) // 2]
+
+    def refresh_at_locked(self):
+        estimate = self.estimate()
+        if estimate is None or self.started_at is None:
+            return None
+        return self.started_at + estimate - min(self.lead, estimate / 5)
+
+    def refresh_at(self):
+        """time.monotonic() to log in again at, or None"""
+        with self.lock:
+            if not (self.enabled and self.lead > 0) or self.attempted == self.started_at:
+                return None
+            return self.refresh_at_locked()
+
+    def refresh_due(self):
+        refresh_at = self.refresh_at()
+        return refresh_at is not None and time.monotonic() >= refresh_at
+
+    def refreshing(self):
+        """About to log in early - only once per session, whatever happens"""
+        with self.lock:
+            self.attempted = self.started_at
+            self.refresh_pending = True
+
+    def status(self):
+        refresh_at = self.refresh_at()
+        return {
+            "estimated_lifetime": self.estimate(),
+            "samples": len(self.lifetimes),
+            "refresh_in": round(max(0, refresh_at - time.monotonic()), 1) if refresh_at else None,
+            "enabled": self.enabled and self.lead > 0,
+        }
+
+
+class MonitorScheduler:
+    """Decides when the monitor loop runs next.
+
+    Waits are interruptible, so stopping is instant and network change events
+    trigger a check right away. The interval drops to min_interval after any
+    trouble and grows by `growth` each stable check up to max_interval.
+
+    Many machines on one network see the same outage at the same moment, so
+    they're kept apart: start_offset delays the very first check, every wait
+    gets up to `jitter` (a fraction) added or taken off, and network change
+    events wait an extra herd_delay on top of settling.
+    """
+
+    def __init__(self, interval, min_interval=5, max_interval=120, growth=1.5, settle=0.5, sources=(), listeners=(),
+                 start_jitter=0, jitter=0, herd_delay=0):
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.interval = min(max(interval, self.min_interval), self.max_interval)
+        self.growth = growth
+        # Network changes come in bursts - give them a moment to finish before checking
+        self.settle = settle
+        self.sources = list(sources)
+        # Called with the reason on every wake-up, e.g. to drop cached WiFi state
+        self.listeners = list(listeners)
+        self.start_offset = random.uniform(0, start_jitter)
+        self.jitter = jitter
+        self.herd_delay = herd_delay
+        # time.monotonic() by which the next check has to happen, like a session refresh.
+        # It can bring a check forward but never closer than min_interval.
+        self.deadline = None
+        self.event = threading.Event()
+        self.stop_event = threading.Event()
+        self.stopped = False
+        self.wake_reason = None
+        self.wakeups = {"timer": 0, "event": 0}
+
+    def start(self):
+        for source in self.sources:
+            try:
+                source.start(self.wake)
+            except OSError as e:
+                logger.warning(f"Could not start network event source: {e}")
+
+    def wake(self, reason="event"):
+        """Make the monitor check now instead of waiting out the interval"""
+        for listener in self.listeners:
+            listener(reason)
+        self.wake_reason = reason
+        self.event.set()
+
+    def stop(self):
+        self.stopped = True
+        self.stop_event.set()
+        self.event.set()
+        for source in self.sources:
+            source.stop()
+
+    def record(self, healthy):
+        """Adjust the interval after a check - tight after trouble, relaxed when stable"""
+        if healthy:
+            self.interval = min(self.interval * self.growth, self.max_interval)
+        else:
+            self.interval = self.min_interval
+
+    def wait(self, timeout=None):
+        """Sleep until the next check is due (or for timeout seconds). Returns False once stopped."""
+        if timeout is None:
+            timeout = self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+            remaining = self.deadline - time.monotonic() if self.deadline is not None else None
+            # A deadline that's already passed would make every wait zero and the loop spin
+            if remaining is not None and remaining > 0:
+                timeout = min(timeout, max(remaining, self.min_interval))
+        woken = self.event.wait(timeout)
+        if woken and not self.stopped:
+            self.wakeups["event"] += 1
+            logger.debug(f"Woken up by network change ({self.wake_reason})")
+            # Somebody asking for a check right now doesn't need to queue behind the rest of the lab
+            delay = self.settle if self.wake_reason == "requested" else self.settle + self.herd_delay
+            self.stop_event.wait(delay)
+        elif not woken:
+            self.wakeups["timer"] += 1
+        self.event.clear()
+        return not self.stopped
+
+
+# What a connectivity probe can tell us
+ONLINE = "online"
+CAPTIVE = "captive"
+OFFLINE = "offline"
+
+ProbeResult = namedtuple("ProbeResult", ["state", "portal_url", "endpoint", "latency"])
+
+# What the app last saw, for the status surfaces. Always replaced whole, never
+# changed in place, so whoever grabs it gets a consistent view without locking.
+StateSnapshot = namedtuple("StateSnapshot", ["ssid", "ssid_at", "probe", "probe_at", "auth"])
+
+
+class ConnectivityProbe:
+    """Works out whether we're online, stuck behind a captive portal, or offline.
+
+    All the endpoints are tried at the same time and the first definitive answer
+    (online or captive) wins, so a check takes about one round trip. We only
+    call it offline once every endpoint has failed or given an answer that
+    says nothing either way, like a 5xx.
+
+    An endpoint whose last probe is still hanging isn't asked again - the check
+    waits on that probe instead - so one stuck endpoint can't tie up the whole
+    pool and make later checks queue behind it.
+    """
+
+    META_REFRESH = re.compile(r"""<meta[^>]+http-equiv=["']?refresh["']?[^>]*url=([^"'>\s]+)""", re.IGNORECASE)
+    JS_REDIRECT = re.compile(r"""(?:window\.)?location(?:\.href)?\s*=\s*["']([^"']+)["']""")
+
+    def __init__(self, transport, endpoints, timeout=3):
+        self.transport = transport
+        self.endpoints = endpoints
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max(1, len(endpoints)), thread_name_prefix="probe")
+        # url -> the future of its latest probe
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    def submit(self, endpoint):
+        """Start probing endpoint, or hand back the probe of it that's still running"""
+        with self.lock:
+            future = self.in_flight.get(endpoint["url"])
+            if future is None or future.done():
+                future = self.in_flight[endpoint["url"]] = self.executor.submit(self.probe, endpoint)
+            return future
+
+    def check(self):
+        """Race all the endpoints and return a ProbeResult"""
+        futures = [self.submit(endpoint) for endpoint in self.endpoints]
+        offline = None
+        for future in as_completed(futures):
+            result = future.result()
+            if result.state != OFFLINE:
+                # Don't care about the stragglers, they'll finish in the background
+                return result
+            offline = result
+        return offline or ProbeResult(OFFLINE, None, None, None)
+
+    def probe(self, endpoint):
+        """Hit a single endpoint and classify the response"""
+        url = endpoint["url"]
+        start = time.monotonic()
+        try:
+            response = self.transport.get(url, timeout=self.timeout, allow_redirects=False)
+        except requests.RequestException:
+            return ProbeResult(OFFLINE, None, url, time.monotonic() - start)
+        latency = time.monotonic() - start
+
+        expected_body = endpoint.get("body")
+        if response.status_code == endpoint.get("status", 204) and (
+                expected_body is None or expected_body in response.text):
+            return ProbeResult(ONLINE, None, url, latency)
+
+        # Something is sitting in the middle - try to find out where it wants us
+        if response.is_redirect and "Location" in response.headers:
+            return ProbeResult(CAPTIVE, urljoin(url, response.headers["Location"]), url, latency)
+        match = self.META_REFRESH.search(response.text) or self.JS_REDIRECT.search(response.text)
+        if match:
+            return ProbeResult(CAPTIVE, urljoin(url, match.group(1)), url, latency)
+        # A page swapped in for the one we asked for (511 is the standard "log in first")
+        if 200 <= response.status_code < 300 or response.status_code == 511:
+            return ProbeResult(CAPTIVE, None, url, latency)
+        # A broken endpoint or a fussy proxy (5xx, 403...) doesn't tell us anything - let the others decide
+        return ProbeResult(OFFLINE, None, url, latency)
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class LinkQuality:
+    """Rolling link quality from cheap periodic samples.
+
+    A sample is one TCP connect to the first probe endpoint - a round trip and
+    nothing else. The last `window` samples sit in a fixed-size array (NaN for
+    one that got no answer), so memory stays the same however long the machine
+    is up. degraded() says what's wrong once there are enough samples: "loss"
+    or "jitter" (the radio link is bad) or "latency" (often a portal throttling
+    a session it no longer likes).
+    """
+
+    MIN_SAMPLES = 10
+
+    def __init__(self, window=60, max_loss=0.3, max_latency=1.5, max_jitter=1.0):
+        self.samples = array("d", [math.nan] * window)
+        self.count = 0
+        self.max_loss = max_loss
+        self.max_latency = max_latency
+        self.max_jitter = max_jitter
+        self.lock = threading.Lock()
+        self.stopped = None
+        self.thread = None
+
+    def add(self, latency):
+        """Record a round trip in seconds, or None if it got no answer"""
+        with self.lock:
+            self.samples[self.count % len(self.samples)] = math.nan if latency is None else latency
+            self.count += 1
+
+    def reset(self):
+        with self.lock:
+            self.count = 0
+
+    def recent(self):
+        """The samples in the window, oldest first"""
+        with self.lock:
+            size = len(self.samples)
+            if self.count <= size:
+                return self.samples[:self.count].tolist()
+            start = self.count % size
+            return (self.samples[start:] + self.samples[:start]).tolist()
+
+    def stats(self):
+        samples = self.recent()
+        answered = [value for value in samples if not math.isnan(value)]
+        stats = {"samples": len(samples), "loss": None, "latency_ms": None, "jitter_ms": None}
+        if not samples:
+            return stats
+        stats["loss"] = round(1 - len(answered) / len(samples), 3)
+        if answered:
+            latencies = sorted(answered)
+            stats["latency_ms"] = {"p50": round(percentile(latencies, 0.5) * 1000, 1),
+                                   "p95": round(percentile(latencies, 0.95) * 1000, 1)}
+        # Jitter is how much each round trip differs from the one before it
+        jitter = sorted(abs(b - a) for a, b in zip(answered, answered[1:]))
+        if jitter:
+            stats["jitter_ms"] = {"p50": round(percentile(jitter, 0.5) * 1000, 1),
+                                  "p95": round(percentile(jitter, 0.95) * 1000, 1)}
+        return stats
+
+    def degraded(self):
+        """"loss", "jitter" or "latency" if that's past its limit, otherwise None"""
+        stats = self.stats()
+        if stats["samples"] < self.MIN_SAMPLES:
+            return None
+        if stats["loss"] > self.max_loss:
+            return "loss"
+        if stats["jitter_ms"] and stats["jitter_ms"]["p95"] > self.max_jitter * 1000:
+            return "jitter"
+        if stats["latency_ms"] and stats["latency_ms"]["p50"] > self.max_latency * 1000:
+            return "latency"
+        return None
+
+    @staticmethod
+    def measure(url, timeout, resolve=socket.getaddrinfo):
+        """Seconds for a TCP connect to url's host, or None if it didn't answer.
+        The lookup (through resolve, a getaddrinfo) isn't part of the time."""
+        parts = urlsplit(url)
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        try:
+            address = resolve(parts.hostname, port, 0, socket.SOCK_STREAM)[0][4]
+            start = time.monotonic()
+            with socket.create_connection(address[:2], timeout=timeout):
+                return time.monotonic() - start
+        except OSError:
+            return None
+
+    def start(self, target, interval, timeout, on_degraded, resolve=socket.getaddrinfo):
+        """Sample target() (a URL) every interval seconds on a background thread"""
+        self.stop()
+        # Each sampler gets its own event - an old one still stuck in measure() after a
+        # quick stop/start sees its own event set and quits, rather than sampling on
+        stopped = self.stopped = threading.Event()
+
+        def sample_loop():
+            was_degraded = None
+            while not stopped.wait(interval):
+                latency = self.measure(target(), timeout, resolve)
+                if stopped.is_set():
+                    break
+                self.add(latency)
+                degraded = self.degraded()
+                # Only wake the monitor when the link goes bad, not on every sample while it stays bad
+                if degraded and not was_degraded:
+                    on_degraded("link quality")
+                was_degraded = degraded
+
+        self.thread = threading.Thread(target=sample_loop, name="link-quality", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.stopped is not None:
+            self.stopped.set()
+
+
+def process_table():
+    """{pid: (ppid, start time)} for every process (works on macOS and Linux)"""
+    try:
+        output = subprocess.check_output(["ps", "-A", "-o", "pid=,ppid=,lstart="]).decode("utf-8")
+    except (OSError, subprocess.CalledProcessError):
+        return {}
+    table = {}
+    for line in output.splitlines():
+        parts = line.split(None, 2)
+        if len(parts) == 3:
+            table[int(parts[0])] = (int(parts[1]), parts[2].strip())
+    return table
+
+
+def process_tree(root_pid):
+    """{pid: start time} for root_pid and all of its descendants, right now"""
+    table = process_table()
+    children = {}
+    for pid, (ppid, _) in table.items():
+        children.setdefault(ppid, []).append(pid)
+    tree, pending = {}, [root_pid]
+    while pending:
+        pid = pending.pop()
+        if pid in table:
+            tree[pid] = table[pid][1]
+            pending.extend(children.get(pid, []))
+    return tree
+
+
+class BrowserPool:
+    """Keeps one warm headless Chrome around and makes sure it gets cleaned up.
+
+    Starting Chrome (and asking webdriver_manager where the driver lives) is the
+    slowest part of a login, so the driver path is cached on disk and the browser
+    is reused between logins until it sits idle for idle_timeout seconds. Whatever
+    happens, the chromedriver/Chrome process tree gets reaped.
+    """
+
+    def __init__(self, idle_timeout=120, cache_file=DRIVER_CACHE_FILE, metrics=None):
+        self.idle_timeout = idle_timeout
+        self.cache_file = cache_file
+        self.metrics = metrics
+        self.browser = None
+        self.lock = threading.RLock()
+        self.idle_timer = None
+        self.counters = {"spawns": 0, "reuses": 0, "reaped": 0, "leaked": 0}
+        atexit.register(self.close)
+
+    def driver_path(self, refresh=False):
+        """Find chromedriver, using the path we found last time if it's still there"""
+        if not refresh:
+            try:
+                with open(self.cache_file, 'r') as f:
+                    path = json.load(f).get("driver_path")
+                if path and os.path.exists(path):
+                    return path
+            except (OSError, ValueError):
+                pass
+
+        from webdriver_manager.chrome import ChromeDriverManager
+        from webdriver_manager.core.os_manager import ChromeType
+
+        # Let's try to use system Chromium first since it's probably there
+        try:
+            path = ChromeDriverManager(chrome_type=ChromeType.CHROMIUM).install()
+        except Exception as e:
+            # Fallback to regular Chrome if Chromium isn't available
+            logger.debug(f"No Chromium driver ({e}), trying Chrome")
+            path = ChromeDriverManager().install()
+
+        try:
+            with open(self.cache_file, 'w') as f:
+                json.dump({"driver_path": path, "resolved_at": time.time()}, f)
+        except OSError as e:
+            logger.warning(f"Could not cache driver path: {e}")
+        return path
+
+    def spawn(self):
+        """Start a fresh headless browser"""
+        from selenium import webdriver
+        from selenium.webdriver.chrome.options import Options
+        from selenium.webdriver.chrome.service import Service
+        from selenium.common.exceptions import WebDriverException
+
+        # Setting up a headless browser - we don't need to see the login window
+        options = Options()
+        options.add_argument("--headless")
+        options.add_argument("--disable-gpu")
+        options.add_argument("--no-sandbox")
+        options.add_argument("--disable-dev-shm-usage")
+        # Lets us see the request the login page actually sends, so we can replay it
+        options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+
+        try:
+            browser = webdriver.Chrome(service=Service(self.driver_path()), options=options)
+        except WebDriverException as e:
+            # Usually a cached driver that no longer matches an updated Chrome
+            logger.info(f"Cached driver failed to start ({e.msg}), resolving it again")
+            browser = webdriver.Chrome(service=Service(self.driver_path(refresh=True)), options=options)
+        self.counters["spawns"] += 1
+        return browser
+
+    @contextmanager
+    def session(self):
+        """Borrow the warm browser (starting one if needed) for a login"""
+        with self.lock:
+            self.cancel_idle_timer()
+            if self.browser is not None and self.healthy():
+                self.counters["reuses"] += 1
+            else:
+                self.reap()
+                if self.metrics:
+                    with self.metrics.time("browser_startup"):
+                        self.browser = self.spawn()
+                else:
+                    self.browser = self.spawn()
+            try:
+                yield self.browser
+            finally:
+                # Reset it for next time - if even that fails, it's not worth keeping
+                try:
+                    self.browser.delete_all_cookies()
+                    self.browser.get("about:blank")
+                except Exception as e:
+                    logger.info(f"Browser is in a bad state ({e}), shutting it down")
+                    self.reap()
+                if self.browser is not None:
+                    self.start_idle_timer()
+
+    def healthy(self):
+        try:
+            self.browser.current_url
+            return True
+        except Exception:
+            return False
+
+    def start_idle_timer(self):
+        self.idle_timer = threading.Timer(self.idle_timeout, self.close)
+        self.idle_timer.daemon = True
+        self.idle_timer.start()
+
+    def cancel_idle_timer(self):
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+            self.idle_timer = None
+
+    def reap(self):
+        """Quit the browser and kill anything from its process tree that's left over"""
+        if self.browser is None:
+            return
+        process = getattr(self.browser.service, "process", None)
+        # Grab the tree right before quitting - once chromedriver is gone, Chrome gets re-parented
+        tree = process_tree(process.pid) if process is not None else {}
+        try:
+            self.browser.quit()
+        except Exception as e:
+            logger.debug(f"Error quitting browser: {e}")
+        self.browser = None
+
+        if tree:
+            survivors = process_table()
+            for pid, started in tree.items():
+                # Same PID and same start time, so it's still our process and not a reused PID
+                if pid in survivors and survivors[pid][1] == started:
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                        self.counters["leaked"] += 1
+                    except OSError:
+                        pass
+        self.counters["reaped"] += 1
+        logger.debug(f"Browser reaped, pool stats: {self.stats()}")
+
+    def close(self):
+        """Shut the browser down now instead of waiting for the idle timeout"""
+        with self.lock:
+            self.cancel_idle_timer()
+            self.reap()
+
+    def stats(self):
+        return dict(self.counters, warm=self.browser is not None)
+
+
+class Histogram:
+    """Fixed-bucket latency histogram (in seconds), Prometheus style"""
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def snapshot(self):
+        cumulative, total = [], 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            cumulative.append([bound, total])
+        return {"count": self.count, "sum": self.sum, "buckets": cumulative}
+
+
+class Metrics:
+    """Phase timings and counters for the monitor, cheap enough to leave on.
+
+    Phases are timed with `with metrics.time("authenticate"):`. Outages are
+    tracked from the check that first noticed the drop to the one that saw
+    us back online.
+    """
+
+    PHASES = ("ssid_check", "connectivity_probe", "wifi_associate", "authenticate", "browser_startup")
+    COUNTERS = ("outages_total", "auth_attempts_total", "auth_failures_total")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {name: Histogram() for name in self.PHASES + ("outage_recovery",)}
+        self.counters = {name: 0 for name in self.COUNTERS}
+        self.outage_started = None
+        self.started = time.time()
+
+    @contextmanager
+    def time(self, phase):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            self.observe(phase, elapsed)
+            log_event("phase_timing", logging.DEBUG, phase=phase, seconds=round(elapsed, 4))
+
+    def observe(self, name, value):
+        with self.lock:
+            self.histograms.setdefault(name, Histogram()).observe(value)
+
+    def inc(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def connection_state(self, online):
+        """Feed in what each monitor cycle ended up with, to track outages"""
+        now = time.monotonic()
+        with self.lock:
+            if not online and self.outage_started is None:
+                self.outage_started = now
+                self.counters["outages_total"] += 1
+                log_event("outage_start")
+            elif online and self.outage_started is not None:
+                duration = now - self.outage_started
+                self.histograms["outage_recovery"].observe(duration)
+                self.outage_started = None
+                log_event("outage_end", seconds=round(duration, 3))
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "uptime_seconds": time.time() - self.started,
+                "in_outage": self.outage_started is not None,
+                "counters": dict(self.counters),
+                "histograms": {name: h.snapshot() for name, h in self.histograms.items()},
+            }
+
+    def prometheus(self):
+        """Render everything in the Prometheus text format"""
+        snapshot = self.snapshot()
+        lines = [f"wifi_reconnector_uptime_seconds {snapshot['uptime_seconds']:.3f}",
+                 f"wifi_reconnector_in_outage {int(snapshot['in_outage'])}"]
+        for name, value in snapshot["counters"].items():
+            lines.append(f"# TYPE wifi_reconnector_{name} counter")
+            lines.append(f"wifi_reconnector_{name} {value}")
+        for name, histogram in snapshot["histograms"].items():
+            metric = f"wifi_reconnector_{name}_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            for bound, count in histogram["buckets"]:
+                lines.append(f'{metric}_bucket{{le="{bound}"}} {count}')
+            lines.append(f'{metric}_bucket{{le="+Inf"}} {histogram["count"]}')
+            lines.append(f"{metric}_sum {histogram['sum']:.6f}")
+            lines.append(f"{metric}_count {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """Serves the metrics on 127.0.0.1 so a local agent can scrape them"""
+
+    def __init__(self, metrics, port):
+        handler = self.make_handler(metrics)
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @staticmethod
+    def make_handler(metrics):
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body, content_type = metrics.prometheus(), "text/plain; version=0.0.4"
+                elif self.path == "/metrics.json":
+                    body, content_type = json.dumps(metrics.snapshot()), "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                data = body.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+    def start(self):
+        self.thread.start()
+        logger.info(f"Serving metrics on http://127.0.0.1:{self.server.server_address[1]}/metrics")
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class AsyncMonitor:
+    """monitor_connection on asyncio instead of one blocking thread.
+
+    Each check asks for the SSID and probes connectivity at the same time, so a
+    cycle takes as long as the slower of the two instead of both added up. Every
+    stage gets its own timeout (stage_timeouts in the config) and is cancelled
+    when it runs over - platform commands run as async subprocesses and get
+    killed. Joining the network and logging in block (Selenium especially), so
+    they go to a small thread pool. Those can't be interrupted half way, so a
+    join or login that overruns is left to finish in the background and no new
+    one is started until it has.
+    """
+
+    def __init__(self, reconnector):
+        self.reconnector = reconnector
+        self.executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="monitor")
+        self.join_future = None
+        self.auth_future = None
+
+    def run(self):
+        """Thread target - runs the loop until monitoring stops"""
+        try:
+            asyncio.run(self.monitor())
+        finally:
+            self.executor.shutdown(wait=False)
+
+    def blocking(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def stage(self, name, awaitable, default=None):
+        """Await one step of a check, giving up on it after its timeout"""
+        timeout = self.reconnector.config["stage_timeouts"].get(name, 30)
+        try:
+            return await asyncio.wait_for(awaitable, timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"{name} took longer than {timeout}s, giving up on it")
+            log_event("stage_timeout", level=logging.WARNING, stage=name, timeout=timeout)
+            return default
+
+    async def current_ssid(self):
+        reconnector = self.reconnector
+        try:
+            with reconnector.metrics.time("ssid_check"):
+                link = await reconnector.backend.link_info_async()
+        except (OSError, ValueError) as e:
+            logger.error(f"Error checking WiFi connection: {e}")
+            return None
+        reconnector.note_link(link)
+        return link.get("ssid")
+
+    async def probe(self):
+        offline = ProbeResult(OFFLINE, None, None, None)
+        # The monitor's own checks are what keep the cache fresh, so they don't read from it
+        return await self.stage("probe", self.blocking(self.reconnector.check_connectivity, True), offline)
+
+    async def associate(self):
+        if self.join_future is not None and not self.join_future.done():
+            logger.info("Previous join is still running, not starting another")
+            return False
+        self.join_future = self.blocking(self.reconnector.connect_to_wifi)
+        # Shielded so a timeout doesn't mark it done while the thread is still going
+        return await self.stage("associate", asyncio.shield(self.join_future), False)
+
+    async def authenticate(self, portal_url=None, force=False):
+        if self.auth_future is not None and not self.auth_future.done():
+            logger.info("Previous login is still running, not starting another")
+            return False
+        self.auth_future = self.blocking(self.reconnector.authenticate, portal_url, force)
+        # Shielded so a timeout doesn't mark it done while the thread is still going
+        return await self.stage("auth", asyncio.shield(self.auth_future), False)
+
+    async def check(self):
+        """One pass of the monitor. Returns (healthy, online)."""
+        reconnector = self.reconnector
+        wifi_name = reconnector.config["wifi_name"]
+        ssid, probe = await asyncio.gather(self.stage("ssid", self.current_ssid()), self.probe())
+
+        if not wifi_name or ssid != wifi_name:
+            logger.info(f"Not connected to {wifi_name}, attempting to connect...")
+            reconnector.publish_status(False)
+            if not await self.associate():
+                return False, False
+            logger.info("Successfully connected to WiFi")
+            # The probe we already have is from before we joined
+            probe = await self.probe()
+            return False, probe.state == ONLINE or await self.authenticate(probe.portal_url)
+
+        if reconnector.reauth_requested:
+            reconnector.reauth_requested = False
+            logger.info("Re-authentication requested")
+            await self.authenticate(force=True)
+            probe = await self.probe()
+        if probe.state == ONLINE:
+            degraded = reconnector.quality.degraded()
+            if degraded:
+                await self.stage("recover", self.blocking(reconnector.recover_link, degraded), False)
+                probe = await self.probe()
+        else:
+            # Samples lost to an outage upstream (or a DNS block) say nothing about the WiFi link
+            reconnector.quality.reset()
+        if probe.state == CAPTIVE:
+            logger.info(f"Captive portal detected ({probe.portal_url or 'no redirect'}), attempting authentication...")
+            reconnector.publish_status(False)
+            return False, await self.authenticate(probe.portal_url)
+        if probe.state == OFFLINE:
+            logger.info("Connected to WiFi but no internet access, attempting authentication...")
+            reconnector.publish_status(False)
+            return False, await self.authenticate()
+        logger.debug(f"Connection is stable ({probe.latency * 1000:.0f} ms)")
+        if reconnector.session.refresh_due():
+            await self.stage("auth", self.blocking(reconnector.refresh_session), False)
+        return True, True
+
+    async def monitor(self):
+        reconnector = self.reconnector
+        logger.info("WiFi reconnection service started (asyncio engine)")
+        scheduler = reconnector.scheduler
+        if scheduler.start_offset and not await self.blocking(scheduler.wait, scheduler.start_offset):
+            return
+
+        while reconnector.running:
+            healthy = False
+            try:
+                healthy, online = await self.check()
+                reconnector.publish_status(online)
+            except Exception as e:
+                logger.error(f"Error in monitor loop: {e}")
+
+            scheduler.record(healthy)
+            # Refreshing the session only makes sense once we're back online
+            scheduler.deadline = reconnector.session.refresh_at() if healthy else None
+            # The scheduler sleeps on a threading.Event, stop() wakes it like it does the thread engine
+            if not await self.blocking(scheduler.wait):
+                break
+
+
+class ControlServer:
+    """Unix socket for asking the running app what's going on, or telling it what to do.
+
+    Speaks newline-delimited JSON, one reply line per request. Send either
+    {"command": "status"} or just the bare word. Commands:
+
+        status         cached state - never touches the network
+        metrics        the same numbers the metrics endpoint serves
+        check-now      run a check straight away
+        reauth         log in to the portal again on the next check (which is now)
+        pause/resume   stop or start monitoring
+        reload-config  re-read wifi_config.json
+
+    Runs its own asyncio loop on a background thread, so any number of scripts
+    can poll it without getting in the monitor's way.
+    """
+
+    def __init__(self, reconnector, path=CONTROL_SOCKET):
+        self.reconnector = reconnector
+        self.path = path
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.clients = set()
+        self.ready = threading.Event()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve, name="control-server", daemon=True)
+        self.thread.start()
+        self.ready.wait(timeout=5)
+        return self
+
+    def serve(self):
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self.open())
+            self.ready.set()
+            self.loop.run_forever()
+        except OSError as e:
+            logger.error(f"Could not start control socket: {e}")
+            self.ready.set()
+        finally:
+            self.loop.close()
+
+    async def open(self):
+        # A socket file left behind by a crash would make the bind fail
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.server = await asyncio.start_unix_server(self.handle_client, path=self.path)
+        # Commands can pause monitoring or trigger logins, so keep it to this user
+        os.chmod(self.path, 0o600)
+        logger.info(f"Control socket listening on {self.path}")
+
+    def stop(self):
+        if self.loop is None or self.loop.is_closed():
+            return
+
+        async def shutdown():
+            self.server.close()
+            # Hang up on anyone still connected so their handlers finish before the loop goes
+            for task in list(self.clients):
+                task.cancel()
+            await asyncio.gather(*self.clients, return_exceptions=True)
+            self.loop.stop()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self.loop)
+        self.thread.join(timeout=2)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    async def handle_client(self, reader, writer):
+        task = asyncio.current_task()
+        self.clients.add(task)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                reply = await self.handle_line(line.decode("utf-8", "replace").strip())
+                writer.write((json.dumps(reply, default=str) + "\n").encode("utf-8"))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self.clients.discard(task)
+            writer.close()
+
+    async def handle_line(self, line):
+        if not line:
+            return {"ok": False, "error": "empty request"}
+        if line.startswith("{"):
+            try:
+                command = json.loads(line).get("command", "")
+            except ValueError:
+                return {"ok": False, "error": "bad JSON"}
+        else:
+            command = line
+        reconnector = self.reconnector
+
+        if command == "status":
+            return {"ok": True, "status": reconnector.status_snapshot()}
+        if command == "metrics":
+            return {"ok": True, "metrics": reconnector.metrics.snapshot()}
+        if command == "check-now":
+            return {"ok": reconnector.check_now()}
+        if command == "reauth":
+            reconnector.reauth_requested = True
+            return {"ok": reconnector.check_now()}
+        # These can block for a moment (joining the monitor thread), so keep them off the loop
+        if command == "pause":
+            return {"ok": await self.loop.run_in_executor(None, reconnector.stop_monitoring)}
+        if command == "resume":
+            return {"ok": await self.loop.run_in_executor(None, reconnector.start_monitoring)}
+        if command == "reload-config":
+            await self.loop.run_in_executor(None, reconnector.reload_config)
+            return {"ok": True}
+        return {"ok": False, "error": f"unknown command: {command}"}
+
+
+class UiTask:
+    """Runs a settings window action off the Tk thread, so the window never freezes.
+
+    steps(cancel) makes a generator that runs on the Tk thread and yields
+    (status, func) pairs. Each func runs on the executor while the status bar
+    shows status, and its return value is sent back into the generator.
+    Everything between the yields happens on the Tk thread, so it can update
+    widgets and ask questions. Finished work comes back through a queue that
+    the Tk thread polls - Tk must only be touched from its own thread.
+
+    cancel() gives up straight away: the generator is closed and the cancel
+    event tells whatever is still running in the background to stop waiting
+    (see wait_until). A login already underway finishes on its own - the
+    monitor may be waiting on the same one - we just stop caring about it.
+    """
+
+    POLL_MS = 50
+
+    def __init__(self, root, executor, steps, on_status, on_finish=None):
+        self.root = root
+        self.executor = executor
+        self.on_status = on_status
+        self.on_finish = on_finish
+        self.cancel_event = threading.Event()
+        self.finished = queue.Queue()
+        self.done = False
+        self.steps = steps(self.cancel_event)
+
+    def start(self):
+        self.advance(None)
+        return self
+
+    def advance(self, value):
+        """Send the last result into the steps and start the next bit of background work"""
+        try:
+            status, func = self.steps.send(value)
+        except StopIteration:
+            self.finish()
+            return
+        except Exception as e:
+            self.fail(e)
+            return
+        self.on_status(status)
+        self.executor.submit(func).add_done_callback(self.finished.put)
+        self.root.after(self.POLL_MS, self.poll)
+
+    def poll(self):
+        if self.done:
+            return
+        try:
+            future = self.finished.get_nowait()
+        except queue.Empty:
+            self.root.after(self.POLL_MS, self.poll)
+            return
+        try:
+            value = future.result()
+        except Exception as e:
+            self.steps.close()
+            self.fail(e)
+            return
+        self.advance(value)
+
+    def cancel(self):
+        if self.done:
+            return
+        self.cancel_event.set()
+        self.steps.close()
+        self.on_status("Cancelled")
+        self.finish()
+
+    def fail(self, error):
+        logger.error(f"Error in settings window task: {error}")
+        self.on_status(f"Failed: {error}")
+        self.finish()
+
+    def finish(self):
+        self.done = True
+        if self.on_finish:
+            self.on_finish()
 
-# Starting with some sensible defaults
-DEFAULT_CONFIG = {
-    "wifi_name": "",
-    "login_url": "",
-    "username": "",
-    "password": "",
-    "check_interval": 30,
-    "auto_start": True
-}
 
 class WifiReconnector:
     def __init__(self):
         self.config = self.load_config()
         self.running = False
         self.thread = None
+        self.scheduler = None
+        # None means "whatever this platform has" - tests and benchmarks can swap in fakes
+        self.event_sources = None
         self.root = None
         self.app = None
+        # Network and browser work started from the settings window runs here, never on the Tk thread
+        self.ui_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ui")
+        self.ui_task = None
+        self.test_button = None
+        self.gui_timer = None
+        self.started_at = time.time()
+        self.state = StateSnapshot(None, None, None, None, None)
+        self.state_lock = threading.Lock()
+        # (ssid, bssid) the last SSID check saw
+        self.last_link = None
+        self.reauth_requested = False
+        self.control_server = None
+        self.metrics = Metrics()
+        self.metrics_server = None
+        self.log_pipeline = None
+        self.backend = make_backend(self.config["network_backend"], self.config["ssid_cache_ttl"])
+        self.selector_cache = SelectorCache()
+        self.browser_pool = BrowserPool(idle_timeout=self.config["browser_idle_timeout"], metrics=self.metrics)
+        self.transport = HttpTransport(pool_size=self.config["http_pool_size"], dns_ttl=self.config["dns_cache_ttl"])
+        self.login_replay = LoginReplay(self.transport)
+        self.probe = ConnectivityProbe(self.transport, self.config["probe_endpoints"], self.config["probe_timeout"])
+        # The GUI, the menu, the control socket and the monitor all ask these -
+        # share one probe (or one login) between whoever asks at the same time
+        self.probe_flight = SingleFlight(self.run_probe, ttl=self.config["probe_cache_ttl"])
+        self.auth_flight = SingleFlight(self.run_authentication)
+        self.auth_retry = RetryPolicy("Login", self.config["retry_base_delay"], self.config["retry_max_delay"])
+        self.associate_retry = RetryPolicy("Joining WiFi", self.config["retry_base_delay"], self.config["retry_max_delay"])
+        self.auth_breaker = CircuitBreaker("auth", self.config["auth_failure_threshold"], self.config["auth_breaker_reset"])
+        self.auth_bucket = TokenBucket(self.config["auth_rate_per_minute"] / 60, self.config["auth_burst"])
+        self.session = SessionTracker(lead=self.config["session_refresh_lead"])
+        self.quality = LinkQuality(self.config["quality_window"], self.config["quality_max_loss"],
+                                   self.config["quality_max_latency_ms"] / 1000, self.config["quality_max_jitter_ms"] / 1000)
         
     def load_config(self):
         """Load configuration from file or create default"""
+        # Everything we keep on disk lives here, so make sure it exists
+        os.makedirs(APP_SUPPORT_DIR, exist_ok=True)
         try:
             if os.path.exists(CONFIG_FILE):
+                # Start from the defaults so settings added in newer versions are always there
+                config = DEFAULT_CONFIG.copy()
                 with open(CONFIG_FILE, 'r') as f:
-                    return json.load(f)
+                    config.update(json.load(f))
+                return config
             else:
                 # First time running, let's create a fresh config
                 return DEFAULT_CONFIG.copy()
@@ -82,179 +2756,551 @@ class WifiReconnector:
     
     def is_connected(self):
         """Check if connected to the internet"""
-        try:
-            # Good old Google - if we can reach this, we're definitely online
-            requests.get("https://www.google.com", timeout=5)
-            return True
-        except requests.ConnectionError:
-            # No dice - either offline or behind a captive portal
-            return False
+        return self.check_connectivity().state == ONLINE
+
+    def check_connectivity(self, fresh=False):
+        """Probe the network - tells captive portals apart from being offline
+
+        Reuses a probe from the last probe_cache_ttl seconds unless fresh is set.
+        """
+        return self.probe_flight(fresh=fresh)
+
+    def run_probe(self):
+        with self.metrics.time("connectivity_probe"):
+            probe = self.probe.check()
+        self.update_state(probe=probe, probe_at=time.time())
+        if probe.state == ONLINE:
+            self.session.seen_online()
+        elif probe.state == CAPTIVE:
+            self.session.expired()
+        return probe
+
+    def update_state(self, **changes):
+        """Swap in a new StateSnapshot - readers just take self.state, no lock needed"""
+        with self.state_lock:
+            self.state = self.state._replace(**changes)
     
-    def is_connected_to_wifi(self):
-        """Check if connected to the specified WiFi network (macOS specific)"""
+    def note_link(self, link):
+        """Record what an SSID check saw. If the OS moved us to another network or access
+        point on its own, the pooled connections and cached DNS answers are for the old one."""
+        seen = (link.get("ssid"), link.get("bssid"))
+        if self.last_link is not None and seen != self.last_link:
+            logger.info(f"Association changed ({self.last_link[0]} -> {seen[0]}), dropping pooled connections")
+            self.transport.invalidate()
+            self.probe_flight.invalidate()
+        self.last_link = seen
+        self.update_state(ssid=seen[0], ssid_at=time.time())
+
+    def is_connected_to_wifi(self, fresh=False):
+        """Check if connected to the specified WiFi network"""
         wifi_name = self.config["wifi_name"]
         if not wifi_name:
             return False
             
         try:
-            # This is the macOS magic to get WiFi info - had to dig for this one!
-            cmd = "/System/Library/PrivateFrameworks/Apple80211.framework/Versions/Current/Resources/airport -I"
-            output = subprocess.check_output(cmd, shell=True).decode('utf-8')
-            
             # Now let's see if we're on the right network
-            for line in output.split('\n'):
-                if ' SSID: ' in line and wifi_name in line:
-                    return True
-            return False
+            with self.metrics.time("ssid_check"):
+                link = self.backend.link_info(fresh)
+            self.note_link(link)
+            return link.get("ssid") == wifi_name
         except Exception as e:
             logger.error(f"Error checking WiFi connection: {e}")
             return False
     
-    def connect_to_wifi(self):
-        """Connect to the college WiFi network (macOS specific)"""
+    def connect_to_wifi(self, force=False, cancel=None):
+        """Connect to the college WiFi network
+
+        Backs off after failed attempts unless force is set (someone clicked a button).
+        Setting the cancel event stops waiting for the join to finish.
+        """
         wifi_name = self.config["wifi_name"]
         if not wifi_name:
             return False
-            
+        if not force and not self.associate_retry.ready():
+            logger.debug(f"Not joining {wifi_name} yet, backing off for {self.associate_retry.retry_in():.0f}s")
+            return False
+
+        self.session.reset()
+        # Samples from the old association say nothing about the new one
+        self.quality.reset()
+        associated = self.associate(wifi_name, cancel)
+        if cancel is not None and cancel.is_set():
+            # Nobody waited long enough to find out - that's not the network's fault
+            return False
+        self.associate_retry.record(associated, None if associated else AUTH_TIMEOUT)
+        return associated
+
+    def associate(self, wifi_name, cancel=None):
         try:
-            # Let macOS do the heavy lifting of connecting us
-            cmd = f'networksetup -setairportnetwork en0 "{wifi_name}"'
-            subprocess.run(cmd, shell=True)
-            
-            # Give it a moment to connect before we check
-            time.sleep(5)
-            return self.is_connected_to_wifi()
+            with self.metrics.time("wifi_associate"):
+                joined = self.backend.associate(wifi_name)
+                # New association means new DNS servers and dead pooled connections
+                self.transport.invalidate()
+                self.probe_flight.invalidate()
+                if not joined:
+                    # The OS already told us it didn't work - no point waiting to see the SSID
+                    logger.error(f"Could not join {wifi_name}")
+                    return False
+
+                # Carry on as soon as we're on the network, don't just sleep and hope
+                associated = self.wait_for_ssid(wifi_name, self.config["associate_timeout"], cancel)
+            if associated:
+                return True
+            if cancel is not None and cancel.is_set():
+                logger.info(f"Stopped waiting to join {wifi_name}")
+                return False
+            logger.error(f"Still not on {wifi_name} after {self.config['associate_timeout']}s")
+            return False
         except Exception as e:
             logger.error(f"Error connecting to WiFi: {e}")
             return False
     
-    def authenticate(self):
-        """Perform web authentication using college credentials"""
-        login_url = self.config["login_url"]
+    def wait_for_ssid(self, ssid, timeout, cancel=None):
+        """Wait until we're associated with ssid"""
+        return wait_until(lambda: self.backend.current_ssid(fresh=True) == ssid, timeout, cancel=cancel)
+
+    def wait_for_online(self, timeout):
+        """Wait until a connectivity probe says we're online"""
+        return wait_until(lambda: self.check_connectivity(fresh=True).state == ONLINE, timeout, interval=0.25)
+
+    def authenticate(self, portal_url=None, force=False):
+        """Perform web authentication using college credentials
+
+        portal_url is the page a captive portal redirected us to, if we saw one -
+        it usually carries session parameters, so it beats the configured URL.
+        If a login is already underway this waits for it and returns its result.
+        Skipped while backing off or while the circuit breaker is open, unless
+        force is set because somebody asked for it.
+        """
+        if not force:
+            if not self.auth_breaker.allow():
+                logger.debug("Not logging in, too many failures (circuit breaker open)")
+                return False
+            if not self.auth_retry.ready():
+                logger.debug(f"Not logging in yet, backing off for {self.auth_retry.retry_in():.0f}s")
+                return False
+            if not self.auth_bucket.take():
+                logger.info("Too many logins lately, holding off")
+                return False
+        return self.auth_flight(portal_url, fresh=True)
+
+    def run_authentication(self, portal_url=None):
+        self.metrics.inc("auth_attempts_total")
+        start = time.monotonic()
+        with self.metrics.time("authenticate"):
+            success, reason = self.log_in(portal_url)
+        if success:
+            self.session.started()
+        else:
+            self.metrics.inc("auth_failures_total")
+        self.auth_retry.record(success, reason)
+        self.auth_breaker.record(success, retryable=reason in RETRYABLE_FAILURES)
+        self.update_state(auth={"success": success, "reason": reason, "time": time.time(),
+                                "seconds": time.monotonic() - start})
+        log_event("auth_result", success=success, reason=reason, seconds=round(time.monotonic() - start, 3),
+                  portal_url=portal_url)
+        return success
+
+    def log_in(self, portal_url=None):
+        """Try each way of logging in, cheapest first. Returns an AuthResult."""
+        login_url = portal_url or self.config["login_url"]
         username = self.config["username"]
         password = self.config["password"]
         
         if not all([login_url, username, password]):
             logger.error("Authentication failed: Missing login credentials")
             # Can't do much without proper credentials
-            return False
-            
+            return AuthResult(False, AUTH_CONFIG)
+
+        if self.config["login_replay"]:
+            # Fastest of all - resend the request that worked last time
+            replayed = self.login_replay.replay(login_url, username, password)
+            if replayed is not None:
+                self.transport.invalidate()
+                if replayed and self.wait_for_online(self.config["auth_verify_timeout"]):
+                    logger.info("Authentication successful (replayed login request)")
+                    return AuthResult(True, None)
+                logger.info("Replayed login didn't get us online, doing a full login")
+                self.login_replay.forget(login_url)
+
+        engine = self.config.get("auth_engine", "auto")
+        if engine != "browser":
+            replay = self.login_replay if self.config["login_replay"] else None
+            page = None
+            if self.config["portal_adapters"]:
+                # A portal we know gets exactly the request its vendor's page would send
+                vendor_login = VendorLogin(self.transport, login_replay=replay)
+                result = vendor_login.login(login_url, username, password)
+                if result or vendor_login.failure in RETRYABLE_FAILURES:
+                    how = vendor_login.adapter.name if vendor_login.adapter else "HTTP"
+                    return self.http_login_result(login_url, result, vendor_login.failure, how)
+                if result is VendorLogin.NOT_RECOGNISED:
+                    page = vendor_login.page
+                else:
+                    # Wrong guess, or a customised portal - the generic login may still manage.
+                    # The adapter's post may have used up the page's tokens, so load it again.
+                    logger.info(f"{vendor_login.adapter.name} login didn't work, trying the generic login")
+            # Try the cheap way first - most portals are just a plain HTML form
+            form_login = HttpFormLogin(self.transport, self.selector_cache, replay)
+            result = form_login.login(login_url, username, password, page=page)
+            if result is not HttpFormLogin.NEEDS_BROWSER:
+                return self.http_login_result(login_url, result, form_login.failure, "HTTP form")
+            if engine == "http":
+                logger.error("Login page needs a browser but auth_engine is set to http")
+                return AuthResult(False, AUTH_FORM_NOT_FOUND)
+
+        result = self.authenticate_with_browser(login_url, username, password)
+        if not result.success:
+            return result
+        if not self.verify_login(login_url):
+            return AuthResult(False, AUTH_TIMEOUT)
+        logger.info("Authentication successful")
+        return result
+
+    def http_login_result(self, login_url, success, failure, how):
+        """Turn an HTTP login's result into an AuthResult, checking it really got us online"""
+        if not success:
+            return AuthResult(False, failure)
+        self.transport.invalidate()
+        if not self.verify_login(login_url):
+            return AuthResult(False, AUTH_TIMEOUT)
+        logger.info(f"Authentication successful ({how})")
+        return AuthResult(True, None)
+
+    def verify_login(self, login_url):
+        """Make sure the portal actually let us through"""
+        if self.wait_for_online(self.config["auth_verify_timeout"]):
+            return True
+        logger.error("Login was submitted but we're still not online")
+        # Whatever we recorded clearly isn't worth replaying
+        self.login_replay.forget(login_url)
+        return False
+
+    def authenticate_with_browser(self, login_url, username, password):
+        """Log in by driving a headless Chrome - for portals that need JavaScript. Returns an AuthResult."""
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.webdriver.support import expected_conditions as EC
+        from selenium.common.exceptions import TimeoutException
+
         try:
-            # Setting up a headless browser - we don't need to see the login window
-            options = Options()
-            options.add_argument("--headless")
-            options.add_argument("--disable-gpu")
-            options.add_argument("--no-sandbox")
-            options.add_argument("--disable-dev-shm-usage")
-            
-            # This is neat - webdriver_manager handles downloading the right Chrome driver
-            # Let's try to use system Chrome first since it's probably there
-            try:
-                service = Service(ChromeDriverManager(chrome_type=ChromeType.CHROMIUM).install())
-                browser = webdriver.Chrome(service=service, options=options)
-            except:
-                # Fallback to regular Chrome if Chromium isn't available
-                service = Service(ChromeDriverManager().install())
-                browser = webdriver.Chrome(service=service, options=options)
-            
-            # Head to the login page
-            browser.get(login_url)
-            
-            # Wait for the page to load - looking for anything that looks like a login form
-            WebDriverWait(browser, 10).until(
-                EC.presence_of_element_located((By.XPATH, "//input[@type='text' or @type='email' or @id='username' or @name='username']"))
-            )
-            
-            # Every site has a different layout, so we need to try various selectors
-            # Let's find that username field
-            username_field = None
-            for selector in ["#username", "[name='username']", "[type='text']", "[type='email']"]:
-                try:
-                    username_field = browser.find_element(By.CSS_SELECTOR, selector)
-                    break
-                except:
-                    continue
-                    
-            # Now for the password field
-            password_field = None
-            for selector in ["#password", "[name='password']", "[type='password']"]:
-                try:
-                    password_field = browser.find_element(By.CSS_SELECTOR, selector)
-                    break
-                except:
-                    continue
-            
-            # And finally the submit button
-            submit_button = None
-            for selector in ["[type='submit']", "button", "#loginButton", ".login-button"]:
-                try:
-                    submit_button = browser.find_element(By.CSS_SELECTOR, selector)
-                    break
-                except:
-                    continue
-            
-            if username_field and password_field and submit_button:
-                # Got all the elements, let's fill out the form
-                username_field.send_keys(username)
-                password_field.send_keys(password)
-                submit_button.click()
-                
-                # Give it a moment to process the login
-                time.sleep(5)
-                browser.quit()
-                
-                logger.info("Authentication successful")
-                return True
-            else:
-                logger.error("Could not find login form elements")
-                browser.quit()
-                # Couldn't figure out this login form - maybe it's not standard
-                return False
-                
+            with self.browser_pool.session() as browser:
+                # Head to the login page
+                browser.get(login_url)
+
+                # Wait for the page to load - looking for anything that looks like a login form
+                WebDriverWait(browser, 10).until(
+                    EC.presence_of_element_located((By.XPATH, "//input[@type='text' or @type='email' or @id='username' or @name='username']"))
+                )
+
+                # Go straight to the fields that worked last time, if the form hasn't changed
+                fingerprint = form_fingerprint(browser.execute_script(FINGERPRINT_JS))
+                cached = self.selector_cache.lookup(login_url, fingerprint)
+                username_selector, username_field = self.find_browser_element(
+                    browser, SelectorCache.ordered(USERNAME_SELECTORS, cached, "username"))
+                password_selector, password_field = self.find_browser_element(
+                    browser, SelectorCache.ordered(PASSWORD_SELECTORS, cached, "password"))
+                submit_selector, submit_button = self.find_browser_element(
+                    browser, SelectorCache.ordered(SUBMIT_SELECTORS, cached, "submit"))
+
+                if username_field and password_field and submit_button:
+                    # Got all the elements, let's fill out the form
+                    username_field.send_keys(username)
+                    password_field.send_keys(password)
+                    form_snapshot = browser.execute_script(CAPTURE_FORM_JS, password_field)
+                    cookies = {cookie["name"]: cookie["value"] for cookie in browser.get_cookies()}
+                    browser.get_log("performance")  # throw away everything from loading the page
+                    page_url = browser.current_url
+                    submit_button.click()
+
+                    # Wait for the portal to deal with it - but no longer than we have to.
+                    # Resetting the browser too early could cut off a script still logging us in.
+                    if not self.wait_for_login_page_exit(browser, page_url, password_field):
+                        logger.error("Login page didn't go anywhere after submitting")
+                        # Could be a wrong password, could be a slow portal - give it another go later
+                        return AuthResult(False, AUTH_TIMEOUT)
+
+                    if self.config["login_replay"]:
+                        self.record_browser_login(browser, login_url, username, password, form_snapshot, cookies)
+                    self.selector_cache.store(login_url, fingerprint, {
+                        "username": username_selector, "password": password_selector, "submit": submit_selector})
+                    # The portal probably stops hijacking DNS now, so forget what we learned
+                    self.transport.invalidate()
+                    return AuthResult(True, None)
+                else:
+                    logger.error("Could not find login form elements")
+                    # Couldn't figure out this login form - maybe it's not standard
+                    return AuthResult(False, AUTH_FORM_NOT_FOUND)
+
         except TimeoutException:
             logger.error("Authentication page timed out")
             # The network might be too slow or the page doesn't load right
-            return False
+            return AuthResult(False, AUTH_TIMEOUT)
         except Exception as e:
             logger.error(f"Authentication error: {str(e)}")
-            return False
+            return AuthResult(False, AUTH_NETWORK)
+
+    def wait_for_login_page_exit(self, browser, page_url, password_field):
+        """Wait until the login went somewhere: the page navigated, the form went
+        away, a success element showed up, or we're just plain online"""
+        from selenium.webdriver.common.by import By
+        from selenium.common.exceptions import StaleElementReferenceException
+
+        success_selector = self.config["login_success_selector"]
+
+        def login_done():
+            try:
+                if success_selector and browser.find_elements(By.CSS_SELECTOR, success_selector):
+                    return True
+                if browser.current_url != page_url:
+                    return True
+                password_field.is_displayed()
+            except StaleElementReferenceException:
+                # The form we filled in is gone
+                return True
+            # Some portals log you in with a script and never leave the page
+            return self.check_connectivity(fresh=True).state == ONLINE
+
+        return wait_until(login_done, self.config["auth_verify_timeout"], interval=0.2)
+
+    def record_browser_login(self, browser, login_url, username, password, form_snapshot, cookies):
+        """Work out which request the login page sent and save it for replaying"""
+        from selenium.common.exceptions import WebDriverException
+
+        request = None
+        try:
+            # The performance log has the real request, even if a script sent it
+            for entry in browser.get_log("performance"):
+                message = json.loads(entry["message"])["message"]
+                if message["method"] != "Network.requestWillBeSent":
+                    continue
+                sent = message["params"]["request"]
+                content_type = {k.lower(): v for k, v in sent.get("headers", {}).items()}.get("content-type", "")
+                if sent["method"] == "POST" and "urlencoded" in content_type and sent.get("postData"):
+                    fields = parse_qsl(sent["postData"], keep_blank_values=True)
+                    if any(value == password for _, value in fields):
+                        request = {"method": "POST", "url": sent["url"], "fields": fields}
+                        break
+        except (WebDriverException, ValueError, KeyError) as e:
+            logger.debug(f"Could not read the browser performance log: {e}")
+        if request is None and form_snapshot:
+            # Fall back to what the form would have submitted
+            request = form_snapshot
+
+        if request is None:
+            logger.info("Could not capture the login request, it won't be replayed")
+            return
+        fields = [tuple(field) for field in request["fields"]]
+        username_field = next((name for name, value in fields if value == username), None)
+        password_field = next((name for name, value in fields if value == password), None)
+        if not password_field:
+            logger.info("Captured login request doesn't carry the password, it won't be replayed")
+            return
+        self.login_replay.record(login_url, request["method"], request["url"], fields,
+                                 username_field, password_field, cookies)
+
+    @staticmethod
+    def find_browser_element(browser, selectors):
+        """Return (selector, element) for the first selector that matches, or (None, None)"""
+        from selenium.webdriver.common.by import By
+
+        for selector in selectors:
+            # find_elements just comes back empty on a miss, no exception to throw away
+            elements = browser.find_elements(By.CSS_SELECTOR, selector)
+            if elements:
+                return selector, elements[0]
+        return None, None
     
     def monitor_connection(self):
         """Main function to monitor and fix WiFi connection"""
         logger.info("WiFi reconnection service started")
+        # Hang on to our own scheduler so a stop/start can't hand us someone else's
+        scheduler = self.scheduler
+        if scheduler.start_offset and not scheduler.wait(scheduler.start_offset):
+            return
         
         while self.running:
+            healthy = False
+            online = False
             try:
                 if not self.is_connected_to_wifi():
                     logger.info(f"Not connected to {self.config['wifi_name']}, attempting to connect...")
+                    self.metrics.connection_state(False)
                     if self.connect_to_wifi():
                         logger.info("Successfully connected to WiFi")
                         # Now that we're connected, let's make sure we're authenticated
-                        self.authenticate()
-                elif not self.is_connected():
-                    logger.info("Connected to WiFi but no internet access, attempting authentication...")
-                    # We're on the right network but can't get to the internet - probably need to log in
-                    self.authenticate()
+                        probe = self.check_connectivity(fresh=True)
+                        online = probe.state == ONLINE or self.authenticate(portal_url=probe.portal_url)
                 else:
-                    logger.debug("Connection is stable")
-                    # All good! We're online and authenticated
-                    
-                # Update the menu bar status so the user knows what's happening
-                if self.app:
-                    status = "Connected" if self.is_connected() else "Disconnected"
-                    self.app.title = f"WiFi: {status}"
+                    if self.reauth_requested:
+                        self.reauth_requested = False
+                        logger.info("Re-authentication requested")
+                        self.authenticate(force=True)
+                    # The monitor's own checks are what keep the cache fresh, so they don't read from it
+                    probe = self.check_connectivity(fresh=True)
+                    if probe.state == ONLINE:
+                        degraded = self.quality.degraded()
+                        if degraded:
+                            self.recover_link(degraded)
+                            probe = self.check_connectivity(fresh=True)
+                    else:
+                        # Samples lost to an outage upstream (or a DNS block) say nothing about the WiFi link
+                        self.quality.reset()
+                    if probe.state == CAPTIVE:
+                        logger.info(f"Captive portal detected ({probe.portal_url or 'no redirect'}), attempting authentication...")
+                        self.metrics.connection_state(False)
+                        online = self.authenticate(portal_url=probe.portal_url)
+                    elif probe.state == OFFLINE:
+                        logger.info("Connected to WiFi but no internet access, attempting authentication...")
+                        self.metrics.connection_state(False)
+                        # We're on the right network but can't get to the internet - probably need to log in
+                        online = self.authenticate()
+                    else:
+                        logger.debug(f"Connection is stable ({probe.latency * 1000:.0f} ms)")
+                        # All good! We're online and authenticated
+                        healthy = online = True
+                        if self.session.refresh_due():
+                            self.refresh_session()
+                self.publish_status(online)
             except Exception as e:
                 logger.error(f"Error in monitor thread: {e}")
                 # Something unexpected happened, but we'll keep trying
                 
             # Wait a bit before checking again - no need to hammer the system
-            time.sleep(self.config["check_interval"])
+            scheduler.record(healthy)
+            # Refreshing the session only makes sense once we're back online
+            scheduler.deadline = self.session.refresh_at() if healthy else None
+            if not scheduler.wait():
+                break
     
+    def recover_link(self, reason):
+        """We're associated but the link is bad - rejoin for loss and jitter, log in again for latency"""
+        stats = self.quality.stats()
+        log_event("link_degraded", level=logging.WARNING, reason=reason, loss=stats["loss"],
+                  latency_ms=stats["latency_ms"], jitter_ms=stats["jitter_ms"])
+        # Judge whatever we do next on fresh samples
+        self.quality.reset()
+        if reason == "latency":
+            return self.authenticate()
+        return self.connect_to_wifi()
+
+    def refresh_session(self):
+        """Log in again just before the portal session is expected to run out"""
+        logger.info("Portal session is about to expire, logging in again")
+        self.session.refreshing()
+        success = self.authenticate()
+        log_event("session_refresh", success=success)
+        return success
+
+    def publish_status(self, online):
+        """Record whether we're online and show it in the menu bar"""
+        self.metrics.connection_state(online)
+        # Update the menu bar status so the user knows what's happening
+        if self.app:
+            status = "Connected" if online else "Disconnected"
+            if not online and self.auth_breaker.state == OPEN:
+                status = "Login failing"
+            self.app.title = f"WiFi: {status}"
+
+    def status_snapshot(self):
+        """What we last saw, for the control socket - only cached values, no network I/O"""
+        state = self.state
+        probe = state.probe
+        return {
+            "monitoring": self.running,
+            "wifi_name": self.config["wifi_name"],
+            "current_ssid": state.ssid,
+            "ssid_time": state.ssid_at,
+            "last_probe": {
+                "state": probe.state,
+                "portal_url": probe.portal_url,
+                "latency_ms": round(probe.latency * 1000, 1) if probe.latency is not None else None,
+                "time": state.probe_at,
+            } if probe else None,
+            "last_auth": state.auth,
+            "uptime_seconds": time.time() - self.started_at,
+            "outages": self.metrics.counters["outages_total"],
+            # How many callers got a shared or cached answer instead of their own probe/login
+            "single_flight": {"probe": dict(self.probe_flight.stats), "auth": dict(self.auth_flight.stats)},
+            "auth_breaker": self.auth_breaker.status(),
+            "backoff": {"auth": self.auth_retry.status(), "associate": self.associate_retry.status()},
+            "auth_rate_limit": self.auth_bucket.status(),
+            "portal_session": self.session.status(),
+            "link_quality": self.quality.stats(),
+        }
+
+    def check_now(self):
+        """Wake the monitor up for an immediate check"""
+        if not (self.running and self.scheduler):
+            return False
+        self.scheduler.wake("requested")
+        return True
+
+    def reload_config(self):
+        """Re-read the config file and apply what can change on the fly"""
+        self.config = self.load_config()
+        self.probe.endpoints = self.config["probe_endpoints"]
+        self.probe.timeout = self.config["probe_timeout"]
+        self.probe_flight.ttl = self.config["probe_cache_ttl"]
+        self.browser_pool.idle_timeout = self.config["browser_idle_timeout"]
+        self.reset_limits()
+        if self.scheduler:
+            self.scheduler.min_interval = self.config["min_check_interval"]
+            self.scheduler.max_interval = max(self.config["max_check_interval"], self.scheduler.min_interval)
+            self.scheduler.interval = self.config["check_interval"]
+            self.scheduler.jitter = self.config["schedule_jitter"]
+            self.scheduler.herd_delay = host_slot(self.config["herd_jitter_window"], self.config["host_id"])
+        logger.info("Configuration reloaded")
+
+    def reset_limits(self):
+        """Apply the retry, rate limit and session settings - and since new
+        settings deserve a fresh try, forget earlier failures"""
+        for policy in (self.auth_retry, self.associate_retry):
+            policy.base = self.config["retry_base_delay"]
+            policy.max_delay = self.config["retry_max_delay"]
+            policy.reset()
+        self.auth_breaker.threshold = self.config["auth_failure_threshold"]
+        self.auth_breaker.reset_timeout = self.config["auth_breaker_reset"]
+        self.auth_breaker.reset()
+        self.auth_bucket.rate = self.config["auth_rate_per_minute"] / 60
+        self.auth_bucket.burst = self.config["auth_burst"]
+        self.session.lead = self.config["session_refresh_lead"]
+        self.quality.max_loss = self.config["quality_max_loss"]
+        self.quality.max_latency = self.config["quality_max_latency_ms"] / 1000
+        self.quality.max_jitter = self.config["quality_max_jitter_ms"] / 1000
+
+    def start_control_server(self):
+        if self.config["control_socket"] and self.control_server is None:
+            self.control_server = ControlServer(self).start()
+
     def start_monitoring(self):
         """Start the monitoring thread"""
         if not self.running:
             self.running = True
-            self.thread = threading.Thread(target=self.monitor_connection, daemon=True)
+            if self.config["metrics_port"] and self.metrics_server is None:
+                try:
+                    self.metrics_server = MetricsServer(self.metrics, self.config["metrics_port"]).start()
+                except OSError as e:
+                    logger.error(f"Could not start metrics server: {e}")
+            self.scheduler = MonitorScheduler(
+                self.config["check_interval"],
+                min_interval=self.config["min_check_interval"],
+                max_interval=self.config["max_check_interval"],
+                sources=self.event_sources if self.event_sources is not None else default_event_sources(),
+                listeners=[self.backend.invalidate, self.probe_flight.invalidate],
+                start_jitter=self.config["start_jitter"],
+                jitter=self.config["schedule_jitter"],
+                herd_delay=host_slot(self.config["herd_jitter_window"], self.config["host_id"]),
+            )
+            self.scheduler.start()
+            if self.config["quality_sample_interval"] and self.probe.endpoints:
+                self.quality.start(lambda: self.probe.endpoints[0]["url"], self.config["quality_sample_interval"],
+                                   self.probe.timeout, self.scheduler.wake, self.transport.dns.getaddrinfo)
+            if self.config["engine"] == "asyncio":
+                target = AsyncMonitor(self).run
+            else:
+                target = self.monitor_connection
+            self.thread = threading.Thread(target=target, daemon=True)
             self.thread.start()
             logger.info("Monitoring started")
             if self.app:
@@ -266,6 +3312,9 @@ class WifiReconnector:
         """Stop the monitoring thread"""
         if self.running:
             self.running = False
+            # Wakes the monitor thread up, so it exits as soon as the current check is done
+            self.scheduler.stop()
+            self.quality.stop()
             if self.thread:
                 self.thread.join(timeout=1.0)
             logger.info("Monitoring stopped")
@@ -274,8 +3323,11 @@ class WifiReconnector:
             return True
         return False
 
-    def create_gui(self):
-        """Create the configuration GUI"""
+    def create_gui(self, show=True):
+        """Create the configuration GUI - run() pumps its events from the menu bar app"""
+        import tkinter as tk
+        from tkinter import ttk
+
         self.root = tk.Tk()
         self.root.title("College WiFi Reconnector")
         self.root.geometry("450x400")
@@ -340,7 +3392,9 @@ class WifiReconnector:
             startup_var.get()
         )).pack(side=tk.LEFT, padx=5)
         
-        ttk.Button(button_frame, text="Test Connection", command=self.test_connection).pack(side=tk.LEFT, padx=5)
+        # Turns into a Cancel button while a test is running
+        self.test_button = ttk.Button(button_frame, text="Test Connection", command=self.test_connection)
+        self.test_button.pack(side=tk.LEFT, padx=5)
         ttk.Button(button_frame, text="Close Window", command=self.hide_window).pack(side=tk.LEFT, padx=5)
         
         # Status bar to show what's happening
@@ -357,11 +3411,14 @@ class WifiReconnector:
         if self.config["auto_start"]:
             self.start_monitoring()
             self.status_var.set("Monitoring active")
-        
-        self.root.mainloop()
+
+        if not show:
+            self.root.withdraw()
     
     def save_settings(self, wifi_name, login_url, username, password, check_interval, auto_start, add_to_login_items):
         """Save settings from GUI to config"""
+        from tkinter import messagebox
+
         try:
             self.config["wifi_name"] = wifi_name
             self.config["login_url"] = login_url
@@ -374,6 +3431,8 @@ class WifiReconnector:
                     # Don't let them set a super short interval - that's just wasteful
                     interval = 10  # Minimum interval
                 self.config["check_interval"] = interval
+                if self.scheduler:
+                    self.scheduler.interval = interval
             except ValueError:
                 messagebox.showerror("Invalid Input", "Check interval must be a number.")
                 return
@@ -381,6 +3440,7 @@ class WifiReconnector:
             self.config["auto_start"] = auto_start
             
             self.save_config()
+            self.reset_limits()
             
             # Handle adding/removing from login items
             if add_to_login_items:
@@ -424,7 +3484,7 @@ class WifiReconnector:
                 f.write(plist_content)
                 
             # Tell launchd about our new agent
-            subprocess.run(f"launchctl load {plist_path}", shell=True)
+            subprocess.run(["launchctl", "load", plist_path])
             logger.info("Added to login items")
         except Exception as e:
             logger.error(f"Error adding to login items: {e}")
@@ -435,48 +3495,73 @@ class WifiReconnector:
             plist_path = os.path.expanduser("~/Library/LaunchAgents/com.wifireconnector.plist")
             if os.path.exists(plist_path):
                 # Unload and delete the launch agent
-                subprocess.run(f"launchctl unload {plist_path}", shell=True)
+                subprocess.run(["launchctl", "unload", plist_path])
                 os.remove(plist_path)
                 logger.info("Removed from login items")
         except Exception as e:
             logger.error(f"Error removing from login items: {e}")
     
     def test_connection(self):
-        """Test the connection and authentication"""
-        self.status_var.set("Testing connection...")
-        
-        if not self.config["wifi_name"]:
+        """Test the connection and authentication in the background - or cancel the test that's running"""
+        if self.ui_task and not self.ui_task.done:
+            self.ui_task.cancel()
+            return
+        self.test_button.config(text="Cancel")
+        self.ui_task = UiTask(self.root, self.ui_executor, self.test_connection_steps, self.status_var.set,
+                              on_finish=lambda: self.test_button.config(text="Test Connection")).start()
+
+    def test_connection_steps(self, cancel):
+        """The connection test, one step at a time (see UiTask) - each yield runs in the background"""
+        from tkinter import messagebox
+
+        wifi_name = self.config["wifi_name"]
+        if not wifi_name:
             messagebox.showerror("Error", "Please enter WiFi network name.")
             self.status_var.set("Test failed: Missing WiFi name")
             return
-            
-        if not self.is_connected_to_wifi():
+
+        on_wifi = yield "Testing connection: checking WiFi...", lambda: self.is_connected_to_wifi(fresh=True)
+        if not on_wifi:
             # We're not on the right network - let's offer to connect
-            result = messagebox.askyesno("Not Connected", 
-                f"You are not connected to {self.config['wifi_name']}. Would you like to connect now?")
-            if result:
-                self.connect_to_wifi()
-            else:
+            if not messagebox.askyesno("Not Connected",
+                    f"You are not connected to {wifi_name}. Would you like to connect now?"):
                 self.status_var.set("Test cancelled")
                 return
-        
-        if not self.is_connected():
-            # Connected to WiFi but no internet - probably need to authenticate
-            result = messagebox.askyesno("No Internet", 
-                "Connected to WiFi but no internet access. Would you like to try authentication?")
-            if result:
-                if self.authenticate():
-                    messagebox.showinfo("Success", "Authentication successful!")
-                    self.status_var.set("Authentication successful")
-                else:
-                    messagebox.showerror("Failed", "Authentication failed. Check your credentials and login URL.")
-                    self.status_var.set("Authentication failed")
-            else:
-                self.status_var.set("Test cancelled")
-        else:
+            joined = yield f"Joining {wifi_name}...", lambda: self.connect_to_wifi(force=True, cancel=cancel)
+            if not joined:
+                messagebox.showerror("Failed", f"Could not join {wifi_name}.")
+                self.status_var.set("Test failed: Could not join WiFi")
+                return
+
+        probe = yield f"On {wifi_name}, checking internet access...", lambda: self.check_connectivity(fresh=True)
+        if probe.state == ONLINE:
             # Everything's working fine!
-            messagebox.showinfo("Success", "You are connected to the internet!")
             self.status_var.set("Connection test successful")
+            messagebox.showinfo("Success", "You are connected to the internet!")
+            return
+
+        # Connected to WiFi but no internet - probably need to authenticate
+        if not messagebox.askyesno("No Internet",
+                "Connected to WiFi but no internet access. Would you like to try authentication?"):
+            self.status_var.set("Test cancelled")
+            return
+        success = yield "Logging in to the portal...", lambda: self.authenticate(probe.portal_url, force=True)
+        if success:
+            self.status_var.set("Authentication successful")
+            messagebox.showinfo("Success", "Authentication successful!")
+        else:
+            self.status_var.set("Authentication failed")
+            messagebox.showerror("Failed", "Authentication failed. Check your credentials and login URL.")
+
+    def pump_gui(self, sender):
+        """Let Tk handle its events - rumps owns the main loop, so this runs from a timer"""
+        import tkinter as tk
+
+        try:
+            self.root.update()
+        except tk.TclError:
+            # The window's gone
+            sender.stop()
     
     def hide_window(self):
         """Hide the main window"""
@@ -500,12 +3585,23 @@ class WifiReconnector:
             self.app.title = "WiFi: Paused"
     
     def show_logs(self, sender):
-        """Open logs file in default text editor"""
-        log_file = os.path.expanduser("~/Library/Logs/wifi_reconnector.log")
-        subprocess.run(["open", log_file])
+        """Show recent activity, with the option of opening the full log file"""
+        import rumps
+
+        recent = self.log_pipeline.recent(15) if self.log_pipeline else []
+        if not recent:
+            subprocess.run(["open", LOG_FILE])
+            return
+        lines = [time.strftime("%H:%M:%S", time.localtime(entry["time"])) + "  " + entry["message"]
+                 for entry in recent]
+        # alert() gives back 0 for the cancel button
+        if rumps.alert(title="Recent Activity", message="\n".join(lines), ok="Close", cancel="Open Full Log") == 0:
+            subprocess.run(["open", LOG_FILE])
     
     def run_menu_app(self):
         """Run the macOS menu bar app"""
+        import rumps  # Need this for the macOS menu bar icon
+
         self.app = rumps.App("WiFi Reconnector", icon="wifi_icon.icns" if os.path.exists("wifi_icon.icns") else None)
         
         # Set up the menu items
@@ -524,12 +3620,19 @@ class WifiReconnector:
         # If auto-start is enabled, start monitoring right away
         if self.config["auto_start"]:
             self.start_monitoring()
+
+        # Both rumps and Tk want the main thread - rumps gets it, and Tk's events are pumped from a timer
+        if self.root:
+            self.gui_timer = rumps.Timer(self.pump_gui, 0.05)
+            self.gui_timer.start()
         
         # Fire up the menu bar app
         self.app.run()
     
     def show_about(self, sender):
         """Show about dialog"""
+        import rumps
+
         rumps.alert(
             title="About WiFi Reconnector",
             message="College WiFi Auto-Reconnector\n\nVersion 1.0\n\nAutomatically reconnects to your college WiFi and handles authentication.",
@@ -538,26 +3641,80 @@ class WifiReconnector:
     
     def quit_app(self, sender):
         """Quit the application"""
+        import rumps
+
         self.stop_monitoring()
+        if self.ui_task:
+            self.ui_task.cancel()
+        self.ui_executor.shutdown(wait=False)
+        if self.control_server:
+            self.control_server.stop()
+        self.browser_pool.close()
         rumps.quit_application()
     
     def run(self):
         """Run the application"""
-        # Start the menu bar app
-        menu_thread = threading.Thread(target=self.run_menu_app)
-        menu_thread.daemon = True
-        menu_thread.start()
-        
-        # Show the settings window on first run or just create it for later
-        if not self.config["wifi_name"]:
-            # First time running - better show them the settings
-            self.create_gui()
-        else:
-            # Just create the window but don't show it
-            self.root = tk.Tk()
-            self.root.withdraw()
-            self.root.protocol("WM_DELETE_WINDOW", self.hide_window)
+        self.start_control_server()
+        # Build the settings window, but only show it on first run - otherwise
+        # it waits hidden until "Open Settings"
+        self.create_gui(show=not self.config["wifi_name"])
+        # The menu bar app runs on the main thread and keeps the window going too
+        self.run_menu_app()
+
+    def run_daemon(self):
+        """Run the monitor with no GUI until we get SIGINT or SIGTERM"""
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *args: stop.set())
+        signal.signal(signal.SIGINT, lambda *args: stop.set())
+
+        self.start_control_server()
+        self.start_monitoring()
+        stop.wait()
+        self.stop_monitoring()
+        if self.control_server:
+            self.control_server.stop()
+        self.browser_pool.close()
+
+    def check_once(self):
+        """One SSID check and connectivity probe, as a dict"""
+        probe = self.check_connectivity()
+        try:
+            ssid = self.backend.current_ssid()
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.warning(f"Could not read the current SSID: {e}")
+            ssid = None
+        return {
+            "ssid": ssid,
+            "on_configured_wifi": bool(ssid) and ssid == self.config["wifi_name"],
+            "state": probe.state,
+            "portal_url": probe.portal_url,
+            "latency_ms": round(probe.latency * 1000, 1) if probe.latency is not None else None,
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Keeps you connected to (and logged into) your school WiFi.")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--daemon", action="store_true", help="run the monitor in the background with no GUI")
+    mode.add_argument("--check-once", action="store_true",
+                      help="check the connection, print it as JSON and exit (0 online, 1 captive portal, 2 offline)")
+    args = parser.parse_args(argv)
 
-if __name__ == "__main__":
     app = WifiReconnector()
-    app.run()
+    if args.check_once:
+        # No log files for a one-off check - just complain on stderr if something breaks
+        logging.basicConfig(level=logging.WARNING, format='%(levelname)s - %(message)s')
+        result = app.check_once()
+        print(json.dumps(result))
+        return {ONLINE: 0, CAPTIVE: 1}.get(result["state"], 2)
+
+    app.log_pipeline = setup_logging(app.config)
+    if args.daemon:
+        app.run_daemon()
+    else:
+        app.run()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())